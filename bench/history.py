@@ -0,0 +1,155 @@
+"""
+Prompt tokens and round latency of a long multi-round chat, with the whole history in the prompt (before) or the history window and the relevant summaries of `HistoryCompressor` (now).
+
+Run from the repository root:
+
+    python -m bench.history --rounds 50 --window 4
+
+A chat of `--rounds` rounds is replayed against the stub server of `bench.mock_openai`, whose chat latency grows with the prompt tokens (`--prompt-token-latency`, the prefill). Each round loads the history, assembles the prompt and sends it, then appends the round to the history. The compressed path summarizes the rounds leaving the window, embeds them and the query on the stub, and keeps the summaries most similar to the query within `--budget-tokens`. It prints the prompt tokens every 10 rounds and the mean round latency.
+"""
+
+import time
+import argparse
+import tempfile
+import numpy as np
+
+from pathlib import Path
+from datetime import datetime
+
+from src.cfg_mappings import ClientConfigs, RAGConfigs
+from src.chunker import estimate_tokens
+from src.history_compressor import HistoryCompressor
+from src.history_store import HistoryStore
+from src.llm_client import get_client
+from src.paper_rag import PaperRAG
+from src.types.agent_info import Conversation
+from bench.mock_openai import MockServer
+
+
+def sentence(rng: np.random.Generator, words: int) -> str:
+    return " ".join(f"w{word}" for word in rng.integers(5000, size=words)) + "."
+
+
+def to_messages(conversations: list[Conversation]) -> list[dict[str, str]]:
+    return [{"role": conv.role, "content": conv.content} for conv in conversations]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--window", type=int, default=4)
+    parser.add_argument("--summary-tokens", type=int, default=96)
+    parser.add_argument("--budget-tokens", type=int, default=512)
+    parser.add_argument("--question-words", type=int, default=30)
+    parser.add_argument("--answer-words", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0001)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    rounds = [
+        (
+            sentence(rng, args.question_words),
+            " ".join(sentence(rng, 20) for _ in range(args.answer_words // 20)),
+        )
+        for _ in range(args.rounds)
+    ]
+    system = {"role": "system", "content": "You are a paper reading assistant."}
+
+    with (
+        MockServer(
+            latency=args.latency, prompt_token_latency=args.prompt_token_latency
+        ) as server,
+        tempfile.TemporaryDirectory() as tmp_dir,
+    ):
+        client_cfgs = ClientConfigs()
+        client = get_client("bench", server.base_url, client_cfgs)
+        rag = PaperRAG(
+            RAGConfigs(
+                num_chunks=512,
+                overlap=64,
+                store_dir=str(Path(tmp_dir) / "rag"),
+                embedding_model="mock-embedding",
+                meta_file=".meta",
+                embed_file="embeddings.npy",
+                embed_dim=args.dim,
+                topk=5,
+                embed_cache_file="",
+                query_cache_file=None,
+            ),
+            client,
+            client_cfgs,
+        )
+
+        def replay(name: str, compressed: bool) -> tuple[list[int], float]:
+            history = HistoryStore(Path(tmp_dir) / f"chat-{name}.json")
+            compressor = HistoryCompressor(
+                Path(tmp_dir) / f"chat-{name}.summaries.json",
+                embed=rag.embed,
+                summary_tokens=args.summary_tokens,
+                budget_tokens=args.budget_tokens,
+            )
+            prompt_tokens, elapsed = [], 0.0
+            for round_id, (question, answer) in enumerate(rounds):
+                start = time.perf_counter()
+                if not compressed:
+                    contents = to_messages(history.read(0, len(history)))
+                else:
+                    conversations = history.tail(args.window * 2)
+                    contents = to_messages(conversations)
+                    if conversations:
+                        compressor.update(history, conversations[0].round_id)
+                    if compressor.has_summaries:
+                        query_embedding = rag.embed_queries([question])[0]
+                        message = compressor.to_message(
+                            compressor.relevant(query_embedding)
+                        )
+                        if message is not None:
+                            contents.insert(0, message)
+                messages = [system, *contents, {"role": "user", "content": question}]
+                client.chat.completions.create(model="mock-chat", messages=messages)
+                elapsed += time.perf_counter() - start
+
+                prompt_tokens.append(
+                    sum(estimate_tokens(message["content"]) for message in messages)
+                )
+                timestamp = datetime.now().isoformat()
+                for role, content in [("user", question), ("assistant", answer)]:
+                    history.append(
+                        Conversation(
+                            conversation_id=f"{name}-{round_id}-{role}",
+                            round_id=round_id,
+                            timestamp=timestamp,
+                            role=role,
+                            content=content,
+                            file_refs=[],
+                        )
+                    )
+            return prompt_tokens, elapsed / len(rounds)
+
+        full_tokens, full_latency = replay("full", compressed=False)
+        compressed_tokens, compressed_latency = replay("compressed", compressed=True)
+
+        print(
+            f"{args.rounds} rounds, window {args.window}, summaries within "
+            f"{args.budget_tokens} tokens, {args.latency * 1e3:.0f} ms per request "
+            f"+ {args.prompt_token_latency * 1e3:.2f} ms per prompt token"
+        )
+        print(f"{'round':>6}{'full':>10}{'compressed':>12}{'reduction':>11}")
+        for i in sorted({*range(9, args.rounds, 10), args.rounds - 1}):
+            full, compressed = full_tokens[i], compressed_tokens[i]
+            print(f"{i + 1:>6}{full:>10}{compressed:>12}{1 - compressed / full:>11.1%}")
+        print(
+            f"{'total':>6}{sum(full_tokens):>10}{sum(compressed_tokens):>12}"
+            f"{1 - sum(compressed_tokens) / sum(full_tokens):>11.1%}"
+        )
+        print(
+            f"mean round latency: full {full_latency:.3f}s, "
+            f"compressed {compressed_latency:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
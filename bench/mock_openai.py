@@ -0,0 +1,170 @@
+"""
+A local stub of the OpenAI-compatible endpoints used by the agent, for the benchmarks: `/embeddings` and `/chat/completions` (not streamed).
+
+Run it on its own to point a configuration at it:
+
+    python -m bench.mock_openai --port 8000 --latency 0.05
+
+Each request sleeps `latency` seconds plus `input_latency` per embedded input, or `prompt_token_latency` per estimated prompt token of a chat (its prefill), like a remote model under no load. The embeddings are deterministic (seeded by the text) and normalized, the chat answer is a fixed text. A share `fail_rate` of the requests is answered with a 429 rate limit error, to exercise the retries.
+"""
+
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+import numpy as np
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.chunker import estimate_tokens
+
+
+class _Server(ThreadingHTTPServer):
+    # Many concurrent sessions connect at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class MockServer:
+    """
+    The stub server, running in a background thread while used as a context manager.
+    """
+
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.05,
+        input_latency: float = 0.0,
+        fail_rate: float = 0.0,
+        answer_tokens: int = 64,
+        prompt_token_latency: float = 0.0,
+    ) -> None:
+        self.latency = latency
+        self.input_latency = input_latency
+        self.prompt_token_latency = prompt_token_latency
+        self.fail_rate = fail_rate
+        self.answer = " ".join(["token"] * answer_tokens)
+        self.num_requests = 0
+        self.num_failed = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections, as a pooled client expects
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status, response = server.respond(self.path, body)
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = _Server(("127.0.0.1", port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "MockServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def embedding(text: str, dim: int) -> list[float]:
+        vector = np.random.default_rng(
+            zlib.crc32(text.encode("utf-8"))
+        ).standard_normal(dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def respond(self, path: str, body: dict) -> tuple[int, dict]:
+        with self._lock:
+            self.num_requests += 1
+            failed = random.random() < self.fail_rate
+            self.num_failed += failed
+        if failed:
+            return 429, {
+                "error": {"message": "Rate limit reached", "type": "rate_limit_error"}
+            }
+
+        if path.endswith("/embeddings"):
+            inputs = body["input"]
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            time.sleep(self.latency + self.input_latency * len(inputs))
+            dim = body.get("dimensions") or 1024
+            return 200, {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {
+                        "object": "embedding",
+                        "index": i,
+                        "embedding": self.embedding(text, dim),
+                    }
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+
+        if path.endswith("/chat/completions"):
+            prompt_tokens = sum(
+                estimate_tokens(message["content"]) for message in body["messages"]
+            )
+            time.sleep(self.latency + self.prompt_token_latency * prompt_tokens)
+            return 200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": self.answer},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(self.answer.split()),
+                    "total_tokens": prompt_tokens + len(self.answer.split()),
+                },
+            }
+
+        return 404, {"error": {"message": f"Unknown endpoint {path}"}}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--input-latency", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with MockServer(
+        args.port, args.latency, args.input_latency, args.fail_rate
+    ) as server:
+        print(f"Serving on {server.base_url}, Ctrl-C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
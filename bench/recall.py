@@ -0,0 +1,123 @@
+"""
+Recall and memory of the approximate indices of `src.vector_index` against the exact `FlatIndex`.
+
+Run from the repository root:
+
+    python -m bench.recall --rows 100000 --dim 1024
+    python -m bench.recall --embeddings rag/embeddings.npy --queries 500
+
+Without `--embeddings` the rows are drawn around random centers, closer to real embeddings than uniform noise. The queries are rows of the store with some noise added. For each index it prints the memory held by the index, recall@k (the share of the exact top `k` it returns) and the search time per query.
+"""
+
+import time
+import argparse
+import numpy as np
+
+from typing import Callable
+
+from src.embedding_store import EmbeddingStore
+from src.vector_index import (
+    FaissIndex,
+    FlatIndex,
+    ProductQuantizedIndex,
+    ScalarQuantizedIndex,
+)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def synthetic_rows(
+    rng: np.random.Generator, rows: int, dim: int, clusters: int
+) -> np.ndarray:
+    centers = normalize(rng.standard_normal((clusters, dim), dtype=np.float32))
+    labels = rng.integers(clusters, size=rows)
+    noise = rng.standard_normal((rows, dim), dtype=np.float32) / np.sqrt(dim)
+    return normalize(centers[labels] + noise).astype(np.float32)
+
+
+def faiss_nbytes(index: FaissIndex) -> int:
+    import faiss
+
+    return len(faiss.serialize_index(index._index))
+
+
+def recall(exact: np.ndarray, found: np.ndarray) -> float:
+    hits = sum(len(set(e) & set(f[f >= 0])) for e, f in zip(exact, found))
+    return hits / exact.size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--embeddings", help="`.npy` file of normalized rows")
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--clusters", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--noise", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--indices",
+        nargs="+",
+        default=["ivf", "hnsw", "int8", "pq"],
+        choices=["ivf", "hnsw", "int8", "pq"],
+    )
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--pq-m", type=int, default=16)
+    parser.add_argument("--rescore-factor", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.embeddings:
+        vectors = np.load(args.embeddings, mmap_mode="r").astype(np.float32)
+    else:
+        vectors = synthetic_rows(rng, args.rows, args.dim, args.clusters)
+    num_rows, dim = vectors.shape
+    queries = vectors[rng.integers(num_rows, size=args.queries)]
+    queries = normalize(
+        queries
+        + args.noise
+        * rng.standard_normal(queries.shape, dtype=np.float32)
+        / np.sqrt(dim)
+    ).astype(np.float32)
+
+    store = EmbeddingStore(dim, capacity=num_rows)
+    store.add(vectors, np.arange(num_rows))
+
+    builders: dict[str, Callable[[], object]] = {
+        "ivf": lambda: FaissIndex(dim, "ivf", nlist=args.nlist, nprobe=args.nprobe),
+        "hnsw": lambda: FaissIndex(dim, "hnsw"),
+        "int8": lambda: ScalarQuantizedIndex(store, args.rescore_factor),
+        "pq": lambda: ProductQuantizedIndex(store, args.pq_m, args.rescore_factor),
+    }
+
+    start = time.perf_counter()
+    _, exact = FlatIndex(store).search(queries, args.k)
+    elapsed = (time.perf_counter() - start) / len(queries)
+    print(f"{num_rows} rows of dimension {dim}, {len(queries)} queries, k={args.k}")
+    print(f"{'index':<8}{'memory MiB':>12}{'recall@k':>10}{'ms/query':>10}")
+    print(
+        f"{'flat':<8}{vectors.nbytes / 2**20:>12.1f}{1.0:>10.3f}{elapsed * 1e3:>10.2f}"
+    )
+
+    for name in args.indices:
+        index = builders[name]()
+        index.build(vectors)
+        if not index.is_ready:
+            print(f"{name:<8} needs at least {index.min_train_size} rows to train")
+            continue
+        start = time.perf_counter()
+        _, found = index.search(queries, args.k)
+        elapsed = (time.perf_counter() - start) / len(queries)
+        nbytes = index.nbytes if hasattr(index, "nbytes") else faiss_nbytes(index)
+        print(
+            f"{name:<8}{nbytes / 2**20:>12.1f}"
+            f"{recall(exact, found):>10.3f}{elapsed * 1e3:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Query latency of the dense, lexical (BM25) and hybrid retrieval modes of `PaperRAG`.
+
+Run from the repository root:
+
+    python -m bench.retrieval --chunks 100000 --dim 1024
+
+The chunks are drawn from a Zipf distributed vocabulary, like the words of real text, and get clustered embeddings (see `bench.recall`). The queries are a few words of random chunks. For each mode it prints the time per query, one query at a time, and with the queries searched as one batch like `PaperRAG.search_batch`.
+"""
+
+import time
+import argparse
+import numpy as np
+
+from bench.recall import normalize, synthetic_rows
+from src.bm25 import BM25Index, reciprocal_rank_fusion
+from src.embedding_store import EmbeddingStore
+from src.vector_index import FlatIndex
+
+
+def synthetic_chunks(
+    rng: np.random.Generator, chunks: int, words: int, vocabulary: int
+) -> list[str]:
+    ranks = np.minimum(rng.zipf(1.2, size=(chunks, words)), vocabulary)
+    return [" ".join(f"w{rank}" for rank in chunk) for chunk in ranks]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--words", type=int, default=300)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--clusters", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=6)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--rrf-k", type=int, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    chunks = synthetic_chunks(rng, args.chunks, args.words, args.vocabulary)
+    vectors = synthetic_rows(rng, args.chunks, args.dim, args.clusters)
+    picked = rng.integers(args.chunks, size=args.queries)
+    queries = [
+        " ".join(rng.choice(chunks[row].split(), size=args.query_words))
+        for row in picked
+    ]
+    query_embeds = normalize(
+        vectors[picked]
+        + rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+        / np.sqrt(args.dim)
+    ).astype(np.float32)
+
+    start = time.perf_counter()
+    bm25 = BM25Index()
+    bm25.add(chunks)
+    print(
+        f"{args.chunks} chunks of {args.words} words, BM25 built in "
+        f"{time.perf_counter() - start:.1f}s, {args.queries} queries, k={args.k}"
+    )
+    store = EmbeddingStore(args.dim, capacity=args.chunks)
+    store.add(vectors, np.arange(args.chunks))
+    index = FlatIndex(store)
+
+    # As `PaperRAG._search_rows`: hybrid fuses rankings deeper than k
+    num_candidates = max(args.k * 4, 50)
+
+    def dense(batch: slice) -> None:
+        index.search(query_embeds[batch], args.k)
+
+    def lexical(batch: slice) -> None:
+        for query in queries[batch]:
+            bm25.search(query, args.k)
+
+    def hybrid(batch: slice) -> None:
+        _, dense_rows = index.search(query_embeds[batch], num_candidates)
+        for query, query_rows in zip(queries[batch], dense_rows):
+            reciprocal_rank_fusion(
+                [query_rows, bm25.search(query, num_candidates)[1]],
+                args.k,
+                args.rrf_k,
+            )
+
+    print(f"{'mode':<10}{'ms/query':>10}{'batched':>10}")
+    for name, search in [("dense", dense), ("lexical", lexical), ("hybrid", hybrid)]:
+        start = time.perf_counter()
+        for i in range(args.queries):
+            search(slice(i, i + 1))
+        single = (time.perf_counter() - start) / args.queries
+        start = time.perf_counter()
+        search(slice(None))
+        batched = (time.perf_counter() - start) / args.queries
+        print(f"{name:<10}{single * 1e3:>10.2f}{batched * 1e3:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
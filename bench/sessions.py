@@ -0,0 +1,139 @@
+"""
+Throughput of concurrent chat sessions on the shared, pooled OpenAI clients of `src.llm_client`, against the stub server of `bench.mock_openai`.
+
+Run from the repository root:
+
+    python -m bench.sessions --sessions 32 --rounds 5 --latency 0.1
+
+A round of a session embeds its query and searches the store (`PaperRAG.search` or `asearch`), then sends a chat completion with the retrieved chunks. The sessions run one after another on the synchronous client (one blocking call at a time, as before), on threads sharing the synchronous client, and as tasks of one event loop sharing the asynchronous client. It prints the sessions per second and the median round latency.
+"""
+
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from src.cfg_mappings import ClientConfigs, RAGConfigs
+from src.llm_client import get_async_client, get_client
+from src.paper_rag import PaperRAG
+from bench.mock_openai import MockServer
+
+
+def messages(query: str, results: list) -> list[dict[str, str]]:
+    context = "\n\n".join(chunk["chunk"] for _, chunk in results)
+    return [
+        {"role": "system", "content": context},
+        {"role": "user", "content": query},
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--max-connections", type=int, default=32)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    client_cfgs = ClientConfigs(
+        max_connections=args.max_connections,
+        max_keepalive_connections=args.max_connections,
+    )
+    with (
+        MockServer(latency=args.latency) as server,
+        tempfile.TemporaryDirectory() as store_dir,
+    ):
+        client = get_client("bench", server.base_url, client_cfgs)
+        rag = PaperRAG(
+            RAGConfigs(
+                num_chunks=256,
+                overlap=32,
+                store_dir=store_dir,
+                embedding_model="mock-embedding",
+                meta_file=".meta",
+                embed_file="embeddings.npy",
+                embed_dim=args.dim,
+                topk=5,
+                embed_cache_file="",
+                query_cache_size=0,
+                query_cache_file=None,
+            ),
+            client,
+            client_cfgs,
+        )
+        for i in range(args.documents):
+            pieces = [
+                " ".join(f"w{word}" for word in rng.integers(5000, size=200))
+                for _ in range(10)
+            ]
+            rag.vectorize_stream(pieces, f"document-{i}.pdf")
+
+        def query(session: int, round_id: int) -> str:
+            return f"question {round_id} of session {session}"
+
+        def run_session(session: int) -> list[float]:
+            latencies = []
+            for round_id in range(args.rounds):
+                start = time.perf_counter()
+                text = query(session, round_id)
+                client.chat.completions.create(
+                    model="mock-chat", messages=messages(text, rag.search(text))
+                )
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        async def arun_session(session: int) -> list[float]:
+            aclient = get_async_client("bench", server.base_url, client_cfgs)
+            latencies = []
+            for round_id in range(args.rounds):
+                start = time.perf_counter()
+                text = query(session, round_id)
+                results = await rag.asearch(text)
+                await aclient.chat.completions.create(
+                    model="mock-chat", messages=messages(text, results)
+                )
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        async def arun_sessions() -> list[list[float]]:
+            return await asyncio.gather(
+                *(arun_session(session) for session in range(args.sessions))
+            )
+
+        def sequential() -> list[list[float]]:
+            return [run_session(session) for session in range(args.sessions)]
+
+        def threaded() -> list[list[float]]:
+            with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+                return list(pool.map(run_session, range(args.sessions)))
+
+        print(
+            f"{args.sessions} sessions of {args.rounds} rounds, "
+            f"{args.latency * 1e3:.0f} ms per request, {args.documents} documents, "
+            f"{args.max_connections} connections"
+        )
+        print(f"{'mode':<14}{'seconds':>10}{'sessions/s':>12}{'round p50 s':>13}")
+        for name, run in [
+            ("sequential", sequential),
+            ("threads", threaded),
+            ("asyncio", lambda: asyncio.run(arun_sessions())),
+        ]:
+            start = time.perf_counter()
+            latencies = [latency for session in run() for latency in session]
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:<14}{elapsed:>10.2f}{args.sessions / elapsed:>12.1f}"
+                f"{statistics.median(latencies):>13.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
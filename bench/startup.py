@@ -0,0 +1,106 @@
+"""
+Startup time of a process using `PDFExtractor`, with the `marker` models loaded lazily (now) or by the constructor (before).
+
+Run from the repository root:
+
+    python -m bench.startup --runs 5
+    python -m bench.startup --pdf paper.pdf
+
+Each measure is the wall time of a new Python process, interpreter start included, the median of `--runs`. A process that only chats or searches builds the extractor but converts nothing, it no longer pays for the models. With `--pdf` it also times the first conversion of a new process, loading the models itself or sending the file to a resident worker (`src.extraction_worker`, started by the benchmark) that keeps them loaded. The rows needing the models are skipped when `marker` is not installed.
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+import importlib.util
+
+from pathlib import Path
+
+EXTRACTOR = """
+from pathlib import Path
+from src.cfg_mappings import ExtractorConfigs
+from src.pdf_extractor import PDFExtractor
+extractor = PDFExtractor(ExtractorConfigs(
+    temperature=0.0, prompt_file="", num_pdf_concurrent=1,
+    output_dir={output_dir!r}, worker_address={worker_address!r},
+))
+"""
+
+
+def time_process(code: str, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def wait_for(path: Path, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"No extraction worker listening on {path}")
+        time.sleep(0.1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--pdf", help="PDF converted by the first conversion rows")
+    parser.add_argument("--worker-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    has_marker = importlib.util.find_spec("marker") is not None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dir = str(Path(tmp_dir) / "outputs")
+        address = str(Path(tmp_dir) / "extractor.sock")
+        extractor = EXTRACTOR.format(output_dir=output_dir, worker_address=None)
+        rows = [
+            ("interpreter only", "pass", False),
+            ("extractor, lazy models", extractor, False),
+            ("extractor, eager models", extractor + "extractor.pdf_converter", True),
+        ]
+        if args.pdf:
+            convert = f"list(extractor.convert_pdfs_to_markdown([Path({args.pdf!r})]))"
+            rows.append(("first conversion", extractor + convert, True))
+
+        print(f"{'process':<32}{'seconds':>10}")
+        for name, code, needs_marker in rows:
+            if needs_marker and not has_marker:
+                print(f"{name:<32}{'marker is not installed':>10}")
+                continue
+            print(f"{name:<32}{time_process(code, args.runs):>10.2f}")
+
+        if not args.pdf or not has_marker:
+            return
+        worker = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "src.extraction_worker",
+                "--address",
+                address,
+                "--output-dir",
+                output_dir,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for(Path(address), args.worker_timeout)
+            code = EXTRACTOR.format(output_dir=output_dir, worker_address=address)
+            print(
+                f"{'first conversion, warm worker':<32}"
+                f"{time_process(code + convert, args.runs):>10.2f}"
+            )
+        finally:
+            worker.terminate()
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Memory, append and search time of `EmbeddingStore` against the former Python lists of vectors.
+
+Run from the repository root:
+
+    python -m bench.store --sizes 10000 100000 1000000 --dim 1024
+
+At 1M rows of dimension 1024 the store holds 4 GiB of float32 (and up to twice that while it doubles), lower `--dim` on a smaller machine. The former layout kept each embedding as a list of Python floats (`np.load(...).tolist()`) and stacked them into a matrix on every query, it is only measured up to `--baseline-rows` rows: its memory is estimated from the object sizes, building it at 1M rows would take tens of GiB.
+"""
+
+import sys
+import time
+import argparse
+import numpy as np
+
+from src.embedding_store import EmbeddingStore
+from src.vector_index import FlatIndex
+
+
+def random_rows(rng: np.random.Generator, rows: int, dim: int) -> np.ndarray:
+    vectors = rng.standard_normal((rows, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def list_nbytes(rows: int, dim: int) -> int:
+    # A list of `dim` float objects per row, and the outer list of rows
+    row = sys.getsizeof([0.0] * dim) + dim * sys.getsizeof(0.0)
+    return rows * row + sys.getsizeof([None] * rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--block-rows", type=int, default=4096)
+    parser.add_argument("--baseline-rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    queries = random_rows(rng, args.queries, args.dim)
+    print(f"dimension {args.dim}, {args.queries} queries, k={args.k}")
+    print(
+        f"{'rows':>9}{'layout':>8}{'memory MiB':>12}{'add s':>8}"
+        f"{'ms/query':>10}{'batched':>10}"
+    )
+
+    for size in args.sizes:
+        # Rows added document by document, the store grows from its default capacity
+        store = EmbeddingStore(args.dim)
+        add_time = 0.0
+        for start in range(0, size, args.block_rows):
+            block = random_rows(rng, min(args.block_rows, size - start), args.dim)
+            begin = time.perf_counter()
+            store.add(block, np.arange(start, start + len(block)))
+            add_time += time.perf_counter() - begin
+        index = FlatIndex(store)
+
+        begin = time.perf_counter()
+        for query in queries:
+            index.search(query, args.k)
+        single = (time.perf_counter() - begin) / args.queries
+        begin = time.perf_counter()
+        index.search(queries, args.k)
+        batched = (time.perf_counter() - begin) / args.queries
+        print(
+            f"{size:>9}{'store':>8}{store.nbytes / 2**20:>12.1f}{add_time:>8.2f}"
+            f"{single * 1e3:>10.2f}{batched * 1e3:>10.2f}"
+        )
+
+        if size > args.baseline_rows:
+            continue
+        embeddings = store.vectors.tolist()
+        begin = time.perf_counter()
+        for query in queries:
+            scores = np.stack(embeddings) @ query
+            np.argsort(-scores)[: args.k]
+        single = (time.perf_counter() - begin) / args.queries
+        print(
+            f"{size:>9}{'lists':>8}{list_nbytes(size, args.dim) / 2**20:>12.1f}"
+            f"{'':>8}{single * 1e3:>10.2f}{'':>10}"
+        )
+        del embeddings
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ from typing import Optional, Union, List
 from dataclasses import dataclass, field
 from hydra.core.config_store import ConfigStore
 
+from src.cfg_mappings import ClientConfigs
+
 
 @dataclass
 class CLISchema:
@@ -43,6 +45,16 @@ class LauncherConfig:
         default="",
         metadata={"help": "Chat model to be used by the OpenAI client."},
     )
+    stream: bool = field(
+        default=True,
+        metadata={"help": "Print the answers token by token as they are generated."},
+    )
+    client: ClientConfigs = field(
+        default_factory=ClientConfigs,
+        metadata={
+            "help": "Connection pool, timeouts and retries of the OpenAI client."
+        },
+    )
 
 
 @dataclass
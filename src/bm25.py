@@ -0,0 +1,142 @@
+import os
+import re
+import math
+import numpy as np
+
+from array import array
+from collections import Counter
+from typing import Optional, Union
+from pathlib import Path
+
+from src.vector_index import positions_to_rows, topk_rows
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def reciprocal_rank_fusion(
+    rankings: list[np.ndarray],
+    k: int,
+    rrf_k: int = 60,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Fuse several rankings of rows (best first) by summing `1 / (rrf_k + rank)`, returns the `k` best `(scores, rows)`.
+    """
+    fused: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            if row >= 0:
+                fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (rrf_k + rank)
+    best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+    return (
+        np.array([score for _, score in best], dtype=np.float32),
+        np.array([row for row, _ in best], dtype=np.int64),
+    )
+
+
+class BM25Index:
+    """
+    An in-process BM25 inverted index over the chunks, row `i` is the `i`-th chunk of the RAG store.
+
+    Searching needs no embedding, so it works offline and catches exact terms (method names, dataset acronyms) that dense retrieval misses. The postings of each term are compact `array`s of rows and term frequencies, rows are only ever appended.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._doc_len = array("i")
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_len)
+
+    def add(self, texts: list[str]) -> None:
+        for text in texts:
+            row = len(self._doc_len)
+            tokens = tokenize(text)
+            for term, tf in Counter(tokens).items():
+                rows, tfs = self._postings.setdefault(term, (array("i"), array("f")))
+                rows.append(row)
+                tfs.append(tf)
+            self._doc_len.append(len(tokens))
+            self._total_len += len(tokens)
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        rows: Optional[Union[slice, np.ndarray]] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The `k` best `(scores, rows)` for `query`, only among `rows` if given. Rows matching no query term are left out.
+        """
+        num_docs = len(self._doc_len)
+        if num_docs == 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        doc_len = np.frombuffer(self._doc_len, dtype=np.int32)
+        norms = self.k1 * (1 - self.b + self.b * doc_len / (self._total_len / num_docs))
+
+        scores = np.zeros(num_docs, dtype=np.float32)
+        for term, qtf in Counter(tokenize(query)).items():
+            if term not in self._postings:
+                continue
+            term_rows, term_tfs = self._postings[term]
+            term_rows = np.frombuffer(term_rows, dtype=np.int32)
+            term_tfs = np.frombuffer(term_tfs, dtype=np.float32)
+            df = len(term_rows)
+            idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+            scores[term_rows] += (
+                qtf * idf * term_tfs * (self.k1 + 1) / (term_tfs + norms[term_rows])
+            )
+
+        candidates = scores if rows is None else scores[rows]
+        top, positions = topk_rows(candidates, k)
+        matched = top > 0
+        return top[matched], positions_to_rows(positions[matched], rows, num_docs)
+
+    def save(self, path: Union[str, Path]) -> None:
+        """
+        Write the index to a temporary file swapped in with `os.replace`, so a concurrent `load` reads either the old or the new snapshot, never a partial one.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        terms = list(self._postings)
+        lengths = np.array([len(self._postings[t][0]) for t in terms], dtype=np.int64)
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                terms=np.array(terms, dtype=str),
+                offsets=np.concatenate([[0], np.cumsum(lengths)]),
+                rows=np.concatenate(
+                    [np.frombuffer(self._postings[t][0], dtype=np.int32) for t in terms]
+                    or [np.empty(0, dtype=np.int32)]
+                ),
+                tfs=np.concatenate(
+                    [
+                        np.frombuffer(self._postings[t][1], dtype=np.float32)
+                        for t in terms
+                    ]
+                    or [np.empty(0, dtype=np.float32)]
+                ),
+                doc_len=np.frombuffer(self._doc_len, dtype=np.int32),
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load(self, path: Union[str, Path]) -> None:
+        with np.load(path) as data:
+            offsets, rows, tfs = data["offsets"], data["rows"], data["tfs"]
+            self._postings = {
+                str(term): (
+                    array("i", rows[offsets[i] : offsets[i + 1]].tobytes()),
+                    array("f", tfs[offsets[i] : offsets[i + 1]].tobytes()),
+                )
+                for i, term in enumerate(data["terms"])
+            }
+            self._doc_len = array("i", data["doc_len"].tobytes())
+        self._total_len = sum(self._doc_len)
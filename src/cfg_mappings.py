@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from typing import Optional
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -8,11 +9,34 @@ class ExtractorConfigs:
     prompt_file: str
     num_pdf_concurrent: int
     output_dir: str
+    # Unix socket of a resident extraction worker (`python -m src.extraction_worker`), optional
+    worker_address: Optional[str] = None
+    # Render, chunk and embed PDFs this many pages at a time, 0 converts whole documents
+    pages_per_step: int = 0
+    # Background image writing: re-encoding format (None keeps marker's), PNG level, WebP/JPEG quality
+    image_format: Optional[str] = None
+    image_compress_level: int = 6
+    image_quality: int = 90
+    image_writers: int = 2
+    max_pending_images: int = 64
+
+
+@dataclass
+class ClientConfigs:
+
+    # Connection pool shared by all the requests of a client, see `src.llm_client`
+    max_connections: int = 32
+    max_keepalive_connections: int = 16
+    # Seconds to connect, and for a whole request
+    connect_timeout: float = 10.0
+    timeout: float = 120.0
+    max_retries: int = 2
 
 
 @dataclass
 class RAGConfigs:
 
+    # Token budget of a chunk, and tokens shared by the windows of a block over the budget, see `src.chunker`
     num_chunks: int
     overlap: int
     store_dir: str
@@ -21,6 +45,42 @@ class RAGConfigs:
     embed_file: str
     embed_dim: int
     topk: int
+    # "memory" loads the embeddings in RAM, "mmap" maps them from disk (see `MmapEmbeddingStore`)
+    storage: str = "memory"
+    merge_threshold: int = 4096
+    # Share of deleted rows (replaced documents) above which the store is rewritten without them
+    compact_ratio: float = 0.2
+    # Embedding requests: inputs and estimated tokens per request, requests in flight, retries on rate limits
+    embed_batch_size: int = 64
+    embed_batch_tokens: int = 8192
+    embed_concurrency: int = 4
+    embed_max_retries: int = 5
+    embed_backoff: float = 1.0
+    # Content-addressed embedding cache in `store_dir`, an empty name disables it
+    embed_cache_file: str = "embed_cache.sqlite"
+    embed_cache_max_mb: int = 512
+    # Search index: "flat" (exact), "ivf" or "hnsw" (approximate, faiss), see `src.vector_index`
+    index_backend: str = "flat"
+    ivf_nlist: int = 1024
+    ivf_nprobe: int = 16
+    hnsw_m: int = 32
+    hnsw_ef_construction: int = 200
+    hnsw_ef_search: int = 64
+    # Compressed in-memory codes instead of the flat index: "int8" (scalar) or "pq" (product, `pq_m` bytes per row,
+    # must divide `embed_dim`), the best `topk * rescore_factor` candidates are re-scored on the memory-mapped float32 rows
+    quantization: Optional[str] = None
+    pq_m: int = 16
+    rescore_factor: int = 4
+    # Retrieval: "dense" (embeddings), "lexical" (BM25, offline) or "hybrid" (reciprocal rank fusion)
+    retrieval: str = "dense"
+    bm25_k1: float = 1.5
+    bm25_b: float = 0.75
+    rrf_k: int = 60
+    # LRU of the queries (embedding and results, persisted in `store_dir`), 0 disables it. Above 1 (the default)
+    # only identical queries reuse results, with a cosine like 0.97 a close dense query reuses them too
+    query_cache_size: int = 1024
+    query_cache_file: Optional[str] = "query_cache.npz"
+    query_cache_similarity: float = 1.01
 
 
 @dataclass
@@ -40,3 +100,19 @@ class Configs:
 
     extractor: ExtractorConfigs
     rag: RAGConfigs
+
+    # PDF name -> document meta file, and content fingerprints of the extracted PDFs (in `output_dir`)
+    index_file: str = ".index"
+    fingerprint_file: str = ".fingerprints"
+    # Settings of the OpenAI clients, given to `get_client` and to `PaperRAG` for its asynchronous client
+    client: ClientConfigs = field(default_factory=ClientConfigs)
+    # Rounds out of `history_window` are summarized by keeping the first `history_summary_tokens` of their messages
+    # (extractive, no LLM call), the summaries relevant to the query are kept in the prompt within
+    # `history_budget_tokens` (0 drops the older rounds)
+    history_summary_tokens: int = 96
+    history_budget_tokens: int = 512
+    # Token budget of the prompt (0 is unlimited), filled with the retrieved chunks and the history in `prompt_priority` order
+    prompt_budget_tokens: int = 8192
+    prompt_priority: list[str] = field(default_factory=lambda: ["rag", "history"])
+    # Seconds between two checks of the prompt files for changes, negative never reloads them
+    prompt_reload_interval: float = 1.0
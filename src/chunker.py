@@ -0,0 +1,120 @@
+import re
+
+from typing import Iterable, Iterator
+
+from src.types.agent_info import DocumentChunk
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A rough token count (~4 characters per token) used to budget chunks and embedding requests.
+    """
+    return len(text) // 4 + 1
+
+
+class MarkdownChunker:
+    """
+    Split markdown (as rendered by marker) into chunks of at most `max_tokens` estimated tokens, following its structure.
+
+    The document is scanned once for blocks: fenced code, or runs of non-blank lines (paragraphs, tables, lists, headings). Consecutive blocks are packed into a chunk while they fit the budget, a heading always starts a new chunk so chunks do not straddle sections. A single block over the budget is cut into windows at whitespace, consecutive windows share `overlap_tokens` tokens.
+
+    Chunks are slices of the source, they carry their `[start, end)` character offsets in it. A document given in pieces (e.g. page ranges) is chunked as the pieces joined by `separator`, pieces have to end on a block boundary, which the blank line separator guarantees.
+    """
+
+    _BLOCK_RE = re.compile(
+        r"^```.*?^```[^\n]*$|(?:^[ \t]*\S[^\n]*(?:\n|\Z))+", re.MULTILINE | re.DOTALL
+    )
+    _HEADING_RE = re.compile(r"#{1,6}\s")
+    _CHARS_PER_TOKEN = 4
+
+    def __init__(
+        self,
+        max_tokens: int,
+        overlap_tokens: int = 0,
+        separator: str = "\n\n",
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.overlap_tokens = min(overlap_tokens, max_tokens // 2)
+        self.separator = separator
+
+    def chunk(self, text: str) -> list[DocumentChunk]:
+        return list(self.iter_chunks([text]))
+
+    def iter_chunks(self, pieces: Iterable[str]) -> Iterator[DocumentChunk]:
+        # The chunk being packed: its parts of text, document offsets and tokens
+        parts: list[str] = []
+        start = end = tokens = 0
+        # Where the last packed block ended, in its piece
+        last_index, last_piece, last_end = -1, "", 0
+
+        offset = 0
+        for i, piece in enumerate(pieces):
+            if i:
+                offset += len(self.separator)
+            for match in self._BLOCK_RE.finditer(piece):
+                block_start, block_end = match.start(), match.end()
+                if piece[block_end - 1 : block_end] == "\n":
+                    block_end -= 1
+                block_tokens = estimate_tokens(piece[block_start:block_end])
+                is_heading = self._HEADING_RE.match(piece, block_start) is not None
+
+                if parts and (is_heading or tokens + block_tokens > self.max_tokens):
+                    yield DocumentChunk("".join(parts), start, end)
+                    parts = []
+
+                if block_tokens > self.max_tokens:
+                    for window_start, window_end in self._windows(
+                        piece, block_start, block_end
+                    ):
+                        yield DocumentChunk(
+                            piece[window_start:window_end],
+                            offset + window_start,
+                            offset + window_end,
+                        )
+                    continue
+
+                if not parts:
+                    parts.append(piece[block_start:block_end])
+                    start, tokens = offset + block_start, 0
+                elif last_index == i:
+                    parts.append(piece[last_end:block_end])
+                else:
+                    # The chunk continues from the previous piece
+                    parts.append(
+                        last_piece[last_end:] + self.separator + piece[:block_end]
+                    )
+                end = offset + block_end
+                tokens += block_tokens
+                last_index, last_piece, last_end = i, piece, block_end
+            offset += len(piece)
+
+        if parts:
+            yield DocumentChunk("".join(parts), start, end)
+
+    def _windows(self, text: str, start: int, end: int) -> Iterator[tuple[int, int]]:
+        """
+        Cut `text[start:end]` into windows of about `max_tokens` tokens ending at whitespace.
+        """
+        size = self.max_tokens * self._CHARS_PER_TOKEN
+        overlap = self.overlap_tokens * self._CHARS_PER_TOKEN
+        while start < end:
+            window_start = start
+            window_end = min(start + size, end)
+            if window_end < end:
+                cut = max(
+                    text.rfind(" ", start + size // 2, window_end),
+                    text.rfind("\n", start + size // 2, window_end),
+                )
+                if cut > start:
+                    window_end = cut
+            yield start, window_end
+            if window_end >= end:
+                return
+            start = window_end - overlap
+            if overlap:
+                # Start the overlap on a word boundary
+                boundary = text.find(" ", start, window_end)
+                start = boundary + 1 if boundary != -1 else start
+            start = max(start, window_start + 1)
+            while start < end and text[start].isspace():
+                start += 1
@@ -0,0 +1,134 @@
+from typing import Any, Optional
+
+from src.chunker import estimate_tokens
+
+# Chunks of a paper at most this many characters apart (the blank line between blocks) are merged
+_ADJACENT_CHARS = 2
+
+# `tiktoken` encoding once loaded, False if it is not available
+_encoding: Any = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    The number of tokens of `text` with the local `tiktoken` tokenizer (`cl100k_base`), or the estimate of `src.chunker` if it is not installed.
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return estimate_tokens(text)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def merge_chunks(chunks: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """
+    Merge the retrieved chunks `{"paper", "chunk", "score", "start", "end"}` of a paper that overlap or are adjacent in it, and drop the duplicated texts. The merged chunks keep the best score and are ordered by it.
+
+    Chunks without offsets (stored before they were recorded) are only deduplicated.
+    """
+    merged = []
+    papers: dict[str, list[dict[str, Any]]] = {}
+    for chunk in chunks:
+        papers.setdefault(chunk["paper"], []).append(chunk)
+    for group in papers.values():
+        located = sorted(
+            (c for c in group if c.get("start") is not None), key=lambda c: c["start"]
+        )
+        current = None
+        for chunk in located:
+            if current is None or chunk["start"] > current["end"] + _ADJACENT_CHARS:
+                current = dict(chunk)
+                merged.append(current)
+                continue
+            if chunk["end"] > current["end"]:
+                gap = chunk["start"] - current["end"]
+                if gap >= 0:
+                    current["chunk"] += "\n" * gap + chunk["chunk"]
+                else:
+                    current["chunk"] += chunk["chunk"][-gap:]
+                current["end"] = chunk["end"]
+            current["score"] = max(current["score"], chunk["score"])
+        merged.extend(c for c in group if c.get("start") is None)
+
+    unique, seen = [], set()
+    for chunk in sorted(merged, key=lambda c: c["score"], reverse=True):
+        key = " ".join(chunk["chunk"].split())
+        if key not in seen:
+            seen.add(key)
+            unique.append(chunk)
+    return unique
+
+
+class ContextPacker:
+    """
+    Fits a prompt in `budget_tokens` tokens: the system prompt and the user query always go in, the remaining budget is filled section by section in `priority` order.
+
+    - `rag`: the merged retrieved chunks, best first. A chunk that does not fit is skipped, a smaller one may still fit.
+    - `history`: the history messages, most recent first, until one does not fit. The older ones are dropped.
+
+    A budget of 0 or less packs everything.
+    """
+
+    def __init__(self, budget_tokens: int, priority: list[str]) -> None:
+        self.budget_tokens = budget_tokens
+        self.priority = list(priority)
+
+    def pack(
+        self,
+        sys_prompts: str,
+        texts: str,
+        rag_chunks: Optional[list[dict[str, Any]]],
+        history: Optional[list[dict[str, str]]],
+    ) -> tuple[Optional[dict[str, str]], list[dict[str, str]]]:
+        """
+        The retrieved chunks as one system message (None without retrieval), and the history messages kept.
+        """
+        unlimited = self.budget_tokens <= 0
+        remaining = self.budget_tokens - count_tokens(sys_prompts) - count_tokens(texts)
+
+        rag_message, kept_history = None, []
+        for section in self.priority:
+            if section == "rag" and rag_chunks is not None:
+                rag_message, used = self.render_chunks(
+                    merge_chunks(rag_chunks), None if unlimited else remaining
+                )
+                remaining -= used
+            elif section == "history" and history:
+                for message in reversed(history):
+                    tokens = count_tokens(message["content"])
+                    if not unlimited and tokens > remaining:
+                        break
+                    kept_history.append(message)
+                    remaining -= tokens
+                kept_history.reverse()
+        return rag_message, kept_history
+
+    def render_chunks(
+        self,
+        chunks: list[dict[str, Any]],
+        budget_tokens: Optional[int] = None,
+    ) -> tuple[dict[str, str], int]:
+        """
+        The chunks fitting in `budget_tokens` (all if None) as a system message, and its number of tokens.
+        """
+        header = "## Reference Documents\n\n"
+        parts, used = [header], count_tokens(header)
+        for chunk in chunks:
+            part = (
+                f"### Document {len(parts)}: {chunk['paper']}\n\n{chunk['chunk']}\n\n"
+            )
+            tokens = count_tokens(part)
+            if budget_tokens is not None and used + tokens > budget_tokens:
+                continue
+            parts.append(part)
+            used += tokens
+        if len(parts) == 1:
+            contents = "No relevant documents found."
+            return {"role": "system", "content": contents}, count_tokens(contents)
+        return {"role": "system", "content": "".join(parts)}, used
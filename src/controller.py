@@ -1,4 +1,5 @@
 import json
+import asyncio
 
 from pathlib import Path
 from dataclasses import asdict
@@ -8,6 +9,11 @@ from typing import Optional, Union, Any
 from src.logger import get_logger
 from src.paper_rag import PaperRAG
 from src.pdf_extractor import PDFExtractor
+from src.fingerprint import FingerprintIndex
+from src.history_store import HistoryStore
+from src.history_compressor import HistoryCompressor
+from src.context_packer import ContextPacker, merge_chunks
+from src.prompt_registry import PromptRegistry
 from src.types.agent_info import (
     AgentInputs,
     AgentOutputs,
@@ -49,26 +55,52 @@ class Controller:
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.conversation_dir = Path(self.cfgs.conversations)
         self.conversation_dir.mkdir(parents=True, exist_ok=True)
+        self.history = HistoryStore(
+            self.conversation_dir / self.chat_file, separator=self.separator
+        )
+
+        self.prompts = PromptRegistry(
+            self.cfgs.init_prompt_dir, self.cfgs.prompt_reload_interval
+        )
 
         self.meta_file = self.cfgs.meta_file
         self._pdf2meta = self._load_pdf2meta()
+        self._fingerprints = FingerprintIndex(
+            self.output_dir / self.cfgs.fingerprint_file
+        )
 
         self.logger.info(f"Document indices loaded")
 
         self.rag = rag
         self.extractor = extractor
+        self.packer = ContextPacker(
+            self.cfgs.prompt_budget_tokens, self.cfgs.prompt_priority
+        )
+        # Rounds out of the history window are summarized, the relevant ones are kept in the prompt
+        self.history_compressor = (
+            HistoryCompressor(
+                self.conversation_dir / f"chat-{self.chat_id}.summaries.json",
+                embed=self.rag.embed,
+                summary_tokens=self.cfgs.history_summary_tokens,
+                budget_tokens=self.cfgs.history_budget_tokens,
+                separator=self.separator,
+            )
+            if self.cfgs.history_budget_tokens > 0
+            else None
+        )
         self.logger.info(f"Models initialized")
 
-    def _load_pdf2meta(self) -> None:
-        if (self.output_dir / self.cfgs.meta_file).exists():
-            with open(self.output_dir / self.cfgs.meta_file, "r") as f:
+    def _load_pdf2meta(self) -> dict[str, str]:
+        # Written by `_write_file_meta_map`
+        if (self.output_dir / self.cfgs.index_file).exists():
+            with open(self.output_dir / self.cfgs.index_file, "r") as f:
                 self._pdf2meta = json.load(f)
         else:
             self._pdf2meta = {}
+        return self._pdf2meta
 
     def _store_pdf2meta(self) -> None:
-        with open(self.output_dir / self.meta_file, "w") as f:
-            json.dump(self._pdf2meta, f, indent=4)
+        self._write_file_meta_map()
 
     def _load_document_meta(self) -> dict[str, str]:
         pass
@@ -95,8 +127,7 @@ class Controller:
         """
         Load a prompt from the init prompt directory.
         """
-        prompt_path = Path(self.cfgs.init_prompt_dir) / f"{prompt_name}.md"
-        return prompt_path.read_text()
+        return self.prompts.get(prompt_name)
 
     def _force_refresh_local_data(self, files: list[Path] = None) -> None:
         files = self._pdf2meta.keys() if files is None else files
@@ -107,8 +138,31 @@ class Controller:
         self._store_pdf2meta()
         self._load_pdf2meta()
 
-    def _rag_search(self, query_texts: str) -> list[tuple[float, dict[str, str]]]:
-        return self.rag.search(query_texts)
+    def _rag_search(
+        self,
+        query_texts: str,
+        files: Optional[list[Path]] = None,
+    ) -> list[tuple[float, dict[str, str]]]:
+        """
+        Search the chunks of `files` only if given, otherwise all the stored documents.
+        """
+        documents = self._document_names(files) if files else None
+        # Only re-reads the store if another process changed it
+        self.rag.refresh()
+        return self.rag.search(query_texts, documents=documents)
+
+    def _document_names(self, files: list[Path]) -> list[str]:
+        """
+        The names the chunks of `files` are stored under: a renamed copy of an extracted file is found by content and shares the chunks of the original.
+        """
+        names = []
+        for f in files:
+            try:
+                outputs = self._fingerprints.lookup(Path(f))
+            except OSError:
+                outputs = None
+            names.append(outputs["pdf_name"] if outputs else Path(f).name)
+        return names
 
     def _search_results_to_query(
         self,
@@ -118,15 +172,31 @@ class Controller:
         `search_results`
             list(tuple(match_score: float, chunk_info: {"filename": str, "chunk": str}))
         """
-        contents = "## Reference Documents\n\n"
-        for i, (score, chunk_info) in enumerate(search_results):
-            contents += f"### Document {i + 1}\n\n"
-            contents += (
-                f"**From**: {chunk_info['filename']}\n"
-                + f"**Match score**: {score}\n\n"
-                + f"**Content**: {chunk_info['chunk']}\n\n"
+        parts = ["## Reference Documents\n\n"]
+        for i, chunk in enumerate(merge_chunks(self._to_rag_chunks(search_results))):
+            parts.append(
+                f"### Document {i + 1}\n\n"
+                f"**From**: {chunk['paper']}\n"
+                f"**Match score**: {chunk['score']}\n\n"
+                f"**Content**: {chunk['chunk']}\n\n"
             )
-        return contents
+        return "".join(parts)
+
+    def _to_rag_chunks(
+        self,
+        search_results: list[tuple[float, dict[str, Any]]],
+    ) -> list[dict[str, Any]]:
+        # The offsets let the packer merge the overlapping chunks of a paper
+        return [
+            {
+                "paper": chunk_info["filename"],
+                "chunk": chunk_info["chunk"],
+                "score": score,
+                "start": chunk_info.get("start"),
+                "end": chunk_info.get("end"),
+            }
+            for score, chunk_info in search_results
+        ]
 
     def preprocess_agent_inputs(
         self,
@@ -153,21 +223,23 @@ class Controller:
             pass
 
         if enable_rag:
-            # TODO search based on provided files only or all files stored
-            search_results = self.rag_search(texts)
+            search_results = self._rag_search(texts, files)
             rag_contents = self._search_results_to_query(search_results)
             query.append({"role": "user", "content": rag_contents})
 
         query.append({"role": "user", "content": texts})
         agent_inputs.query = query
 
-    def _load_history_conversations(self) -> list[Conversation]:
-        history_file = self.conversation_dir / self.chat_file
-        convs = list[Conversation] = []
-        contents = open(history_file, "r").read().split(self.separator)
-        for content in contents:
-            convs.append(Conversation(**json.loads(content)))
-        return convs
+    def _load_history_conversations(
+        self,
+        window: Optional[int] = None,
+    ) -> list[Conversation]:
+        """
+        The last `window` conversations of the chat, all of them if None. Only those are read from the history file.
+        """
+        if window is None:
+            return self.history.read(0, len(self.history))
+        return self.history.tail(window)
 
     def _store_one_conversation(
         self,
@@ -187,11 +259,8 @@ class Controller:
             content=content,
             file_refs=file_refs,
         )
-        json_str = json.dumps(asdict(conversation))
-        history_file = self.conversation_dir / self.chat_file
-        with open(history_file, "a") as f:
-            f.write(json_str + self.separator)
-        return history_file
+        self.history.append(conversation)
+        return self.history.path
 
     def _convert_conversations_to_message(
         self,
@@ -217,6 +286,7 @@ class Controller:
             "num_images": extractor_output.num_images,
             "images": list(extractor_output.images),
             "pdf": str(extractor_output.save_dir / extractor_output.pdf_name),
+            "sha256": self._fingerprints.fingerprint(extractor_output.pdf_path),
         }
         with open(meta_file, "w") as f:
             json.dump(meta_data, f, indent=4)
@@ -235,57 +305,114 @@ class Controller:
     def _store_file_in_markdown(
         self,
         file_paths: Union[list[Path], Path],
-    ) -> ExtractorOutput:
+    ) -> list[ExtractorOutput]:
+        """
+        Convert the files into markdowns, concurrently, the failed ones are skipped. They are only registered by `_store_markdown_in_rag`, once embedded.
+        """
         if isinstance(file_paths, Path):
             file_paths = [file_paths]
-        # Update the stored markdowns in the disk
-        results: list[ExtractorOutput] = [
-            self.extractor.convert_pdf_to_markdown(f) for f in file_paths
-        ]
-        for res in results:
-            # Update meta file in the disk
-            self._save_extractor_output(res)
-            # Update the file indices in the memory not the disk
-            self._update_file_meta_map(
-                pdf_name=res.pdf_name,
-                meta_file=res.save_dir / self.cfgs.meta_file,
-            )
-        # Write the file indices to the disk
+        return list(self.extractor.convert_pdfs_to_markdown(file_paths))
+
+    def _register_extractor_output(self, res: ExtractorOutput) -> None:
+        # Update meta file in the disk
+        self._save_extractor_output(res)
+        # Update the file indices in the memory not the disk
+        self._update_file_meta_map(
+            pdf_name=res.pdf_name,
+            meta_file=res.save_dir / self.cfgs.meta_file,
+        )
+        self._fingerprints.record(
+            res.pdf_path,
+            pdf_name=res.pdf_name,
+            meta_file=str(res.save_dir / self.cfgs.meta_file),
+        )
+
+    def _stream_file_in_rag(
+        self,
+        file_paths: list[Path],
+    ) -> list[ExtractorOutput]:
+        """
+        Extract, chunk and embed the files `extractor.pages_per_step` pages at a time, the embedding of a page range overlaps with the rendering of the next one. The failed files are skipped.
+        """
+        results: list[ExtractorOutput] = []
+        self.rag.refresh()
+        for f in file_paths:
+            stream = self.extractor.stream_pdf_to_markdown(f)
+            try:
+                self.rag.vectorize_stream(stream, f.name)
+            except Exception as e:
+                self.logger.warning(f"Failed to stream PDF {f} into the RAG: {e}")
+                continue
+            self._register_extractor_output(stream.output)
+            results.append(stream.output)
         self._write_file_meta_map()
+        self._fingerprints.save()
         return results
 
+    def _detect_changed_files(self, file_paths: list[Path]) -> list[Path]:
+        """
+        Files whose content was never extracted. A known content under a new name (a renamed or copied file) is only registered under that name, it is not extracted again.
+        """
+        changed = []
+        for f in file_paths:
+            outputs = self._fingerprints.lookup(f)
+            if outputs is None:
+                changed.append(f)
+            elif f.name not in self._pdf2meta:
+                self._update_file_meta_map(f.name, outputs["meta_file"])
+        if len(changed) < len(file_paths):
+            self._write_file_meta_map()
+        # Persist the hashed (size, mtime) so the next check takes the fast path
+        self._fingerprints.save()
+        return changed
+
     def _store_markdown_in_rag(
         self,
-        pdf_markdown_maps: dict[str, Path],
-    ) -> tuple[Path]:
+        extractor_out: list[ExtractorOutput],
+    ) -> list[ExtractorOutput]:
         """
-        Store markdown into RAG vector store, no matter if the markdowns are already stored in the vector store, this method will always refresh the vector store with the new markdowns. So make sure the markdowns are filtered before calling.
+        Store the markdowns of `extractor_out` into the RAG vector store, replacing the rows of documents already stored. So make sure the markdowns are filtered before calling.
+
+        Each document is embedded and persisted on its own, and only then registered (file index and fingerprint): a failed one is skipped without dropping the others, and is extracted again on the next run.
         """
-        vector_store_path = self.rag.get_vector_store_meta_path()
-        vector_store_meta_path = self.rag.get_vector_store_meta_path()
-        if vector_store_path.exists() and vector_store_meta_path.exists():
-            self.rag.load_index()
-            self.rag.load_meta()
-        self.rag.vectorize_markdowns(pdf_markdown_maps)
-        return vector_store_path, vector_store_meta_path
+        results: list[ExtractorOutput] = []
+        # Rows are appended after the ones on disk, catch up with other processes first
+        self.rag.refresh()
+        for out in extractor_out:
+            try:
+                self.rag.vectorize_markdowns(
+                    {out.pdf_name: out.save_dir / out.markdown_name}
+                )
+            except Exception as e:
+                self.logger.warning(f"Failed to store {out.pdf_name} into the RAG: {e}")
+                continue
+            self._register_extractor_output(out)
+            results.append(out)
+        self._write_file_meta_map()
+        self._fingerprints.save()
+        return results
 
     def _load_document_chunks(
         self,
         query_texts: str,
+        files: Optional[list[Path]] = None,
     ) -> list[dict[str, Any]]:
         try:
-            self.rag.load_index()
-            self.rag.load_meta()
-            id2cid = self.rag.id2chunk
-            query_embeds = self.rag.embed(query_texts)
-            _, ids = self.rag.search(query_embeds)
-            print(ids)
-            chunks = []
-            for cid in ids[0]:
-                if cid in id2cid:
-                    uuid_key = id2cid[cid]
-                    chunks.append(self.rag._meta[uuid_key])
-            return chunks
+            return self._to_rag_chunks(self._rag_search(query_texts, files))
+        except Exception as e:
+            self.logger.warning(f"Failed to load document chunks: {e}")
+            return []
+
+    async def _aload_document_chunks(
+        self,
+        query_texts: str,
+        files: Optional[list[Path]] = None,
+    ) -> list[dict[str, Any]]:
+        try:
+            documents = self._document_names(files) if files else None
+            await asyncio.to_thread(self.rag.refresh)
+            search_results = await self.rag.asearch(query_texts, documents=documents)
+            return self._to_rag_chunks(search_results)
         except Exception as e:
             self.logger.warning(f"Failed to load document chunks: {e}")
             return []
@@ -294,12 +421,8 @@ class Controller:
         self,
         rag_chunks: list[dict[str, Any]],
     ) -> dict[str, str]:
-        doc = "## Reference Documents\n\n"
-        for i, chunk in enumerate(rag_chunks):
-            doc += f"### Document {i + 1}: {chunk['paper']}\n\n"
-            doc += f"{chunk['chunk']}\n\n"
-        contents = {"role": "system", "content": doc}
-        return contents
+        message, _ = self.packer.render_chunks(merge_chunks(rag_chunks))
+        return message
 
     def _preprocess(
         self,
@@ -324,29 +447,80 @@ class Controller:
             multiround (bool, optional): If True, the method will load the history messages and concatenate them with the user query. Defaults to False.
         """
         files: list[Path] = agent_inputs.files
-        texts: str = agent_inputs.texts
-        enable_rag: bool = enable_rag
+        self._ingest_files(files, force_refresh)
+        texts, enable_rag = self._default_texts(agent_inputs.texts, files, enable_rag)
 
+        sys_prompts = self._load_sys_prompts(enable_rag)
+        rag_chunks = None
+        if enable_rag:
+            self.logger.info("Using RAG to retrieve relevant documents")
+            rag_chunks = self._load_document_chunks(texts, files)
+            self.logger.info(f"{len(rag_chunks)} found in vector store")
+        history = self._load_history_messages(texts) if multiround else None
+
+        return self._assemble_inputs(
+            agent_inputs, texts, files, sys_prompts, rag_chunks, history
+        )
+
+    async def _apreprocess(
+        self,
+        agent_inputs: AgentInputs,
+        force_refresh: bool = False,
+        multiround: bool = False,
+        enable_rag: bool = False,
+    ) -> AgentInputs:
+        """
+        `_preprocess` for the event loop: once the files are stored, the retrieval (the query is embedded on the shared asynchronous client), the history and the system prompts are loaded concurrently.
+        """
+        files: list[Path] = agent_inputs.files
+        await asyncio.to_thread(self._ingest_files, files, force_refresh)
+        texts, enable_rag = self._default_texts(agent_inputs.texts, files, enable_rag)
+
+        async def _rag_chunks() -> Optional[list[dict[str, Any]]]:
+            if not enable_rag:
+                return None
+            self.logger.info("Using RAG to retrieve relevant documents")
+            rag_chunks = await self._aload_document_chunks(texts, files)
+            self.logger.info(f"{len(rag_chunks)} found in vector store")
+            return rag_chunks
+
+        async def _history() -> Optional[tuple[list[dict[str, str]], list[Path]]]:
+            if not multiround:
+                return None
+            return await asyncio.to_thread(self._load_history_messages, texts)
+
+        sys_prompts, rag_chunks, history = await asyncio.gather(
+            asyncio.to_thread(self._load_sys_prompts, enable_rag),
+            _rag_chunks(),
+            _history(),
+        )
+        return self._assemble_inputs(
+            agent_inputs, texts, files, sys_prompts, rag_chunks, history
+        )
+
+    def _ingest_files(self, files: list[Path], force_refresh: bool = False) -> None:
+        """
+        Extract and store the new or changed `files` (all of them if `force_refresh`) into markdowns and the vector store.
+        """
         if force_refresh:
             self.logger.info(
-                f"`force_refresh` is enabled, all files "
+                f"`force_refresh` is enabled, the provided files "
                 f"will be re-extractied into markdowns and "
                 f"re-stored into vector stores."
             )
             self.logger.info(f"Following files will be refreshed: {files}")
-            extractor_out = self._store_file_in_markdown(files)
-            self._store_markdown_in_rag(
-                {out.paper_title: out.save_dir / out.save_name for out in extractor_out}
-            )
+            self._store_markdown_in_rag(self._store_file_in_markdown(files))
 
-        # Detect the repeated files
-        candidate_files = [f for f in files if f.name not in self._pdf2meta.keys()]
+        # Detect the new or changed files by content, the unchanged ones are skipped
+        candidate_files = self._detect_changed_files(files)
         if candidate_files:
-            self.logger.info(f"Following files will be newly stored: {files}")
-            extractor_out = self._store_file_in_markdown(candidate_files)
-            self._store_markdown_in_rag(
-                {out.paper_title: out.save_dir / out.save_name for out in extractor_out}
-            )
+            self.logger.info(f"Following files will be newly stored: {candidate_files}")
+            if self.cfgs.extractor.pages_per_step > 0:
+                self._stream_file_in_rag(candidate_files)
+            else:
+                self._store_markdown_in_rag(
+                    self._store_file_in_markdown(candidate_files)
+                )
 
         self.logger.info(
             f"Files are all extracted/stored:"
@@ -354,49 +528,76 @@ class Controller:
             f"\nRAG: {self.cfgs.rag.store_dir}"
         )
 
-        if not texts:
-            enable_rag = False
-            if not files:
-                texts = open(Path(self.cfgs.init_prompt_dir) / "_greetings.md").read()
-            else:
-                texts = open(Path(self.cfgs.init_prompt_dir) / "_summary.md").read()
+    def _default_texts(
+        self,
+        texts: str,
+        files: list[Path],
+        enable_rag: bool,
+    ) -> tuple[str, bool]:
+        """
+        Without a text query, greet the user or summarize the files, with no retrieval.
+        """
+        if texts:
+            return texts, enable_rag
+        texts = self._load_prompt("_summary" if files else "_greetings")
+        return texts, False
 
-        sys_prompts = open(
-            Path(self.cfgs.init_prompt_dir)
-            / f"_sys_prompts{'_rag' if enable_rag else ''}.md"
-        ).read()
-        agent_inputs.query = [{"role": "system", "content": sys_prompts}]
+    def _load_sys_prompts(self, enable_rag: bool) -> str:
+        return self._load_prompt(f"_sys_prompts{'_rag' if enable_rag else ''}")
 
-        if enable_rag:
-            self.logger.info("Using RAG to retrieve relevant documents")
-            import traceback
+    def _load_history_messages(
+        self,
+        texts: str,
+    ) -> tuple[list[dict[str, str]], list[Path]]:
+        """
+        The conversations of the last `history_window` rounds, preceded by the summaries of the older rounds relevant to `texts`.
+        """
+        # A round is a user and an assistant conversation
+        conversations = self._load_history_conversations(self.win_size * 2)
+        contents, refs = self._convert_conversations_to_message(conversations)
+        if self.history_compressor is None or not conversations:
+            return contents, refs
 
-            try:
-                rag_chunks = self._load_document_chunks(texts)
-            except Exception as e:
-                traceback.print_exc()
-                raise RuntimeError(e)
-            self.logger.info(f"{len(rag_chunks)} found in vector store")
-            if rag_chunks:
-                rag_contents = self._convert_rag_chunks_to_message(rag_chunks)
-                agent_inputs.query.extend(rag_contents)
-            else:
-                agent_inputs.query.append(
-                    {"role": "system", "content": "No relevant documents found."}
-                )
+        try:
+            self.history_compressor.update(self.history, conversations[0].round_id)
+            if not self.history_compressor.has_summaries:
+                return contents, refs
+            # Usually cached already by the retrieval of the same query
+            query_embedding = self.rag.embed_queries([texts])[0]
+            summaries = self.history_compressor.relevant(query_embedding)
+        except Exception as e:
+            self.logger.warning(f"Failed to compress the history: {e}")
+            return contents, refs
+        message = self.history_compressor.to_message(summaries)
+        if message is not None:
+            contents.insert(0, message)
+        return contents, refs
+
+    def _assemble_inputs(
+        self,
+        agent_inputs: AgentInputs,
+        texts: str,
+        files: list[Path],
+        sys_prompts: str,
+        rag_chunks: Optional[list[dict[str, Any]]],
+        history: Optional[tuple[list[dict[str, str]], list[Path]]],
+    ) -> AgentInputs:
+        """
+        Build the query within `prompt_budget_tokens`, see `ContextPacker`. `rag_chunks` and `history` are None when they are not used.
+        """
+        contents, refs = history if history is not None else ([], [])
+        rag_message, contents = self.packer.pack(
+            sys_prompts, texts, rag_chunks, contents
+        )
 
-        if multiround:
-            conversations = self._load_history_conversations()
-            contents, refs = self._convert_conversations_to_message(
-                conversations[-self.win_size * 2 :]
-                if len(conversations) > self.win_size * 2
-                else conversations
-            )
-            agent_inputs.query.extend(contents)
-            agent_inputs.files.extend(refs)
+        agent_inputs.query = [{"role": "system", "content": sys_prompts}]
+        if rag_message is not None:
+            agent_inputs.query.append(rag_message)
+        agent_inputs.query.extend(contents)
+        agent_inputs.files.extend(refs)
 
         agent_inputs.query.append({"role": "user", "content": texts})
         agent_inputs.files.extend(files)
-        agent_inputs.files = list[set(agent_inputs.files)]
+        agent_inputs.files = list(set(agent_inputs.files))
 
         return agent_inputs
@@ -0,0 +1,151 @@
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+from typing import Optional, Union
+from pathlib import Path
+
+
+class EmbeddingCache:
+    """
+    A persistent, content-addressed embedding cache backed by SQLite.
+
+    Entries are keyed by `(model, dim, sha256(text))`, so the same chunk is embedded only once per model and dimension, no matter which document or refresh it comes from. When the stored vectors exceed `max_bytes`, the least recently used entries are evicted. Their total size is kept up to date by triggers in the database, shared by the processes using the cache, rather than summed on every write.
+    """
+
+    # Stay below SQLite's limit of host parameters per statement
+    _QUERY_BATCH = 500
+
+    def __init__(self, path: Union[str, Path], max_bytes: int) -> None:
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, "
+            "dim INTEGER NOT NULL, "
+            "digest TEXT NOT NULL, "
+            "vector BLOB NOT NULL, "
+            "last_used REAL NOT NULL, "
+            "PRIMARY KEY (model, dim, digest))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        self._conn.commit()
+        # The size table and its triggers, the first time summing the existing entries
+        self._conn.executescript(
+            "BEGIN IMMEDIATE;"
+            "CREATE TABLE IF NOT EXISTS size ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), "
+            "bytes INTEGER NOT NULL);"
+            "INSERT OR IGNORE INTO size "
+            "SELECT 0, COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings;"
+            "CREATE TRIGGER IF NOT EXISTS embeddings_insert AFTER INSERT ON embeddings "
+            "BEGIN UPDATE size SET bytes = bytes + LENGTH(NEW.vector); END;"
+            "CREATE TRIGGER IF NOT EXISTS embeddings_delete AFTER DELETE ON embeddings "
+            "BEGIN UPDATE size SET bytes = bytes - LENGTH(OLD.vector); END;"
+            "CREATE TRIGGER IF NOT EXISTS embeddings_update "
+            "AFTER UPDATE OF vector ON embeddings BEGIN UPDATE size "
+            "SET bytes = bytes + LENGTH(NEW.vector) - LENGTH(OLD.vector); END;"
+            "COMMIT;"
+        )
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @property
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def get_many(
+        self,
+        model: str,
+        dim: int,
+        texts: list[str],
+    ) -> list[Optional[np.ndarray]]:
+        digests = [self.digest(text) for text in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(digests), self._QUERY_BATCH):
+                batch = digests[i : i + self._QUERY_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT digest, vector FROM embeddings "
+                    f"WHERE model = ? AND dim = ? "
+                    f"AND digest IN ({', '.join('?' * len(batch))})",
+                    (model, dim, *batch),
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? "
+                    "WHERE model = ? AND dim = ? AND digest = ?",
+                    [(now, model, dim, d) for d in found],
+                )
+                self._conn.commit()
+        results = [
+            np.frombuffer(found[d], dtype=np.float32) if d in found else None
+            for d in digests
+        ]
+        num_hits = sum(r is not None for r in results)
+        self.hits += num_hits
+        self.misses += len(results) - num_hits
+        return results
+
+    def put_many(
+        self,
+        model: str,
+        dim: int,
+        texts: list[str],
+        vectors: np.ndarray,
+    ) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), dim)
+        now = time.time()
+        with self._lock:
+            # An upsert rather than `INSERT OR REPLACE`, whose implicit delete does not
+            # fire the delete trigger
+            self._conn.executemany(
+                "INSERT INTO embeddings VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (model, dim, digest) DO UPDATE "
+                "SET vector = excluded.vector, last_used = excluded.last_used",
+                [
+                    (model, dim, self.digest(text), vector.tobytes(), now)
+                    for text, vector in zip(texts, vectors)
+                ],
+            )
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self._conn.execute("SELECT bytes FROM size").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        rowids = []
+        for rowid, size in self._conn.execute(
+            "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used"
+        ):
+            rowids.append((rowid,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM embeddings WHERE rowid = ?", rowids)
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,361 @@
+import os
+import struct
+import threading
+import numpy as np
+
+from typing import Optional, Union
+from pathlib import Path
+from contextlib import nullcontext
+
+from src.file_lock import FileLock
+
+
+class EmbeddingStore:
+    """
+    A growable, contiguous float32 matrix of normalized embeddings with a parallel int64 id array.
+
+    Rows are appended in place and the capacity is doubled when it runs out, so adding `n` rows costs amortized O(n). `vectors` and `ids` are views over the filled rows, searching never copies the matrix.
+    """
+
+    def __init__(self, dim: int, capacity: int = 1024) -> None:
+        self.dim = dim
+        self._size = 0
+        self._vectors = np.empty((max(capacity, 1), dim), dtype=np.float32)
+        self._ids = np.empty((max(capacity, 1),), dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return self._vectors.shape[0]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[: self._size]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[: self._size]
+
+    def rows_from(self, start: int) -> np.ndarray:
+        return self.vectors[start:]
+
+    @property
+    def nbytes(self) -> int:
+        return self._vectors.nbytes + self._ids.nbytes
+
+    def _reserve(self, size: int) -> None:
+        if size <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        ids = np.empty((capacity,), dtype=np.int64)
+        vectors[: self._size] = self._vectors[: self._size]
+        ids[: self._size] = self._ids[: self._size]
+        self._vectors, self._ids = vectors, ids
+
+    def add(self, vectors: np.ndarray, ids: Union[np.ndarray, list[int]]) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if vectors.shape[0] != ids.shape[0]:
+            raise ValueError(f"Got {vectors.shape[0]} vectors but {ids.shape[0]} ids.")
+        n = vectors.shape[0]
+        self._reserve(self._size + n)
+        rows = self._vectors[self._size : self._size + n]
+        rows[:] = vectors
+        norms = np.linalg.norm(rows, axis=1, keepdims=True)
+        np.divide(rows, norms, out=rows, where=norms > 0)
+        self._ids[self._size : self._size + n] = ids
+        self._size += n
+
+    def scores_batch(
+        self,
+        queries: np.ndarray,
+        rows: Optional[Union[slice, np.ndarray]] = None,
+    ) -> np.ndarray:
+        """
+        Cosine similarities of shape `(len(queries), num_rows)` in one matrix-matrix product.
+
+        `rows` restricts the scoring to some rows, a slice scores a view of the matrix without copying it.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        vectors = self.vectors if rows is None else self.vectors[rows]
+        return queries @ vectors.T
+
+    def save(self, path: Union[str, Path]) -> None:
+        np.save(path, self.vectors)
+
+
+class MmapEmbeddingStore:
+    """
+    An on-disk embedding store that is memory-mapped instead of loaded, so opening it does not read the rows and processes on one host share the page cache.
+
+    The rows live in two files:
+
+    - `path`: a read-only `.npy` base matrix, opened with `np.load(mmap_mode="r")`.
+    - `path.with_suffix(".seg")`: an append-only segment with a 16 bytes header (magic, dim, number of base rows it follows) and raw float32 rows. A segment following another number of base rows is out of date (its rows were merged) and ignored.
+
+    Rows added in this process are kept in memory until `save` appends them to the segment. Once the segment grows past `merge_threshold` rows it is merged into the base in a background thread. Files are never truncated while they may be mapped: the merged base and the new segment replace the old ones with `os.replace`, the mappings of the old files stay valid. The ids of the base and segment rows are owned by the caller (the RAG metadata), only the ids of the pending rows are kept here.
+
+    `lock` is the inter-process lock of the writers of the files, the merge thread takes it. The caller holds it around `save` and `truncate`.
+    """
+
+    _MAGIC = b"PAEMBSEG"
+    _HEADER = struct.Struct("<8sII")
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        dim: int,
+        merge_threshold: int = 4096,
+        lock: Optional[FileLock] = None,
+    ) -> None:
+        self.path = Path(path)
+        self.segment_path = self.path.with_suffix(".seg")
+        self.dim = dim
+        self.merge_threshold = merge_threshold
+        self.lock = lock
+
+        self._lock = threading.Lock()
+        self._merger: Optional[threading.Thread] = None
+        self._pending = EmbeddingStore(dim)
+        # Rows on disk past this one are not exposed, see `limit`
+        self._max_rows: Optional[int] = None
+        # The segment is missing or out of date, `save` starts a new one
+        self._segment_stale = False
+        self._maps = self._map()
+
+    def __len__(self) -> int:
+        base, segment = self._maps
+        return len(base) + len(segment) + len(self._pending)
+
+    @property
+    def nbytes(self) -> int:
+        return self._pending.nbytes
+
+    @property
+    def pending(self) -> np.ndarray:
+        """
+        The rows added since the last `save`.
+        """
+        return self._pending.vectors
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """
+        All the rows as one matrix. Unlike `EmbeddingStore.vectors` this is a copy, it is meant for (re)building indices, not for searching.
+        """
+        base, segment = self._maps
+        return np.concatenate([base, segment, self._pending.vectors])
+
+    def rows_from(self, start: int) -> np.ndarray:
+        """
+        The rows from `start` on, as a copy. Only those rows are read.
+        """
+        base, segment = self._maps
+        return np.concatenate(
+            [
+                base[start:],
+                segment[max(start - len(base), 0) :],
+                self._pending.vectors[max(start - len(base) - len(segment), 0) :],
+            ]
+        )
+
+    def _map_base(self) -> np.ndarray:
+        if not self.path.exists():
+            return np.empty((0, self.dim), dtype=np.float32)
+        try:
+            base = np.load(self.path, mmap_mode="r")
+        except ValueError:
+            # An empty matrix can not be mapped
+            base = np.load(self.path)
+        return base.reshape(-1, self.dim)
+
+    def _reset_segment(self, base_rows: int) -> None:
+        """
+        Replace the segment with an empty one following `base_rows` base rows.
+        """
+        tmp_path = self.segment_path.with_suffix(".seg.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(self._HEADER.pack(self._MAGIC, self.dim, base_rows))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.segment_path)
+        self._segment_stale = False
+
+    def _map_segment(self, base_rows: int) -> np.ndarray:
+        empty = np.empty((0, self.dim), dtype=np.float32)
+        self._segment_stale = True
+        if not self.segment_path.exists():
+            return empty
+        with open(self.segment_path, "rb") as f:
+            magic, dim, segment_base_rows = self._HEADER.unpack(
+                f.read(self._HEADER.size)
+            )
+        if magic != self._MAGIC or dim != self.dim:
+            raise ValueError(
+                f"{self.segment_path} is not an embedding segment of dimension {self.dim}."
+            )
+        if segment_base_rows != base_rows:
+            # Merged into the base by a merge interrupted before starting a new segment
+            return empty
+        self._segment_stale = False
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        num_rows = (self.segment_path.stat().st_size - self._HEADER.size) // row_bytes
+        if num_rows == 0:
+            return empty
+        return np.memmap(
+            self.segment_path,
+            dtype=np.float32,
+            mode="r",
+            offset=self._HEADER.size,
+            shape=(num_rows, self.dim),
+        )
+
+    def _map(self) -> tuple[np.ndarray, np.ndarray]:
+        base = self._map_base()
+        segment = self._map_segment(len(base))
+        if self._max_rows is not None:
+            base = base[: self._max_rows]
+            segment = segment[: max(self._max_rows - len(base), 0)]
+        return base, segment
+
+    def limit(self, num_rows: int) -> None:
+        """
+        Only expose the first `num_rows` rows on disk, without modifying the files: the rows past them are being written by another process, or were left by a crash.
+        """
+        with self._lock:
+            self._max_rows = num_rows
+            self._maps = self._map()
+
+    def add(self, vectors: np.ndarray, ids: Union[np.ndarray, list[int]]) -> None:
+        with self._lock:
+            self._pending.add(vectors, ids)
+
+    def scores_batch(
+        self,
+        queries: np.ndarray,
+        rows: Optional[Union[slice, np.ndarray]] = None,
+    ) -> np.ndarray:
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        base, segment = self._maps
+        parts = [base, segment, self._pending.vectors]
+        if rows is None:
+            return np.concatenate([queries @ part.T for part in parts], axis=1)
+
+        rows = np.arange(len(self))[rows] if isinstance(rows, slice) else rows
+        scores = np.empty((len(queries), len(rows)), dtype=np.float32)
+        offset = 0
+        for part in parts:
+            mask = (rows >= offset) & (rows < offset + len(part))
+            if mask.any():
+                scores[:, mask] = queries @ part[rows[mask] - offset].T
+            offset += len(part)
+        return scores
+
+    def save(self, path: Optional[Union[str, Path]] = None) -> None:
+        """
+        Append the pending rows to the segment, `path` is accepted for compatibility with `EmbeddingStore` and must be the store path.
+        """
+        with self._lock:
+            if len(self._pending):
+                if self._segment_stale:
+                    self._reset_segment(len(self._map_base()))
+                with open(self.segment_path, "ab") as f:
+                    f.write(self._pending.vectors.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._pending = EmbeddingStore(self.dim)
+                self._maps = self._map()
+        if len(self._maps[1]) >= self.merge_threshold:
+            self.merge_async()
+
+    def merge(self) -> None:
+        """
+        Merge the segment into the base matrix, under the inter-process `lock`.
+
+        The new base is streamed into a temporary file and swapped in with `os.replace`, then a new empty segment is swapped in the same way. Readers that still map the old files keep valid (old) inodes, they see the merged rows once they map the files again, never twice: the old segment follows fewer base rows than the new base. A crash between the two swaps leaves that old segment, ignored for the same reason, so no row is lost.
+        """
+        with self.lock.exclusive() if self.lock is not None else nullcontext():
+            with self._lock:
+                base = self._map_base()
+                segment = self._map_segment(len(base))
+                if len(segment) == 0:
+                    return
+                num_rows = len(base) + len(segment)
+                tmp_path = self.path.with_suffix(".merging.npy")
+                merged = np.lib.format.open_memmap(
+                    tmp_path, mode="w+", dtype=np.float32, shape=(num_rows, self.dim)
+                )
+                merged[: len(base)] = base
+                merged[len(base) :] = segment
+                merged.flush()
+                del merged
+                os.replace(tmp_path, self.path)
+                self._reset_segment(num_rows)
+                self._maps = self._map()
+
+    def write_rows(
+        self, rows: np.ndarray, path: Union[str, Path], block_rows: int = 65536
+    ) -> None:
+        """
+        Write `rows` of the store, in order, as a new store at `path` (a base matrix and an empty segment), e.g. the rows kept by a compaction. The rows are copied block by block, this store is not modified.
+        """
+        path = Path(path)
+        tmp_path = path.with_suffix(".merging.npy")
+        with self._lock:
+            parts = [*self._maps, self._pending.vectors]
+            out = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.float32, shape=(len(rows), self.dim)
+            )
+            for start in range(0, len(rows), block_rows):
+                block = rows[start : start + block_rows]
+                offset = 0
+                for part in parts:
+                    mask = (block >= offset) & (block < offset + len(part))
+                    if mask.any():
+                        out[start : start + len(block)][mask] = part[
+                            block[mask] - offset
+                        ]
+                    offset += len(part)
+            out.flush()
+            del out
+        os.replace(tmp_path, path)
+        segment_path = path.with_suffix(".seg")
+        with open(segment_path.with_suffix(".seg.tmp"), "wb") as f:
+            f.write(self._HEADER.pack(self._MAGIC, self.dim, len(rows)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(segment_path.with_suffix(".seg.tmp"), segment_path)
+
+    def truncate(self, num_rows: int) -> None:
+        """
+        Drop the rows on disk from `num_rows` on, e.g. rows written without their metadata before a crash. The pending rows are kept.
+
+        The files are modified in place, the caller must be the only writer of the store.
+        """
+        with self._lock:
+            self._max_rows = None
+            base, segment = self._maps = self._map()
+            if num_rows >= len(base) + len(segment):
+                return
+            if num_rows >= len(base):
+                row_bytes = self.dim * np.dtype(np.float32).itemsize
+                size = self._HEADER.size + (num_rows - len(base)) * row_bytes
+                self._maps = (base, segment[:0])
+                os.truncate(self.segment_path, size)
+            else:
+                tmp_path = self.path.with_suffix(".merging.npy")
+                np.save(tmp_path, np.asarray(base[:num_rows]))
+                os.replace(tmp_path, self.path)
+                self._reset_segment(num_rows)
+            self._maps = self._map()
+
+    def merge_async(self) -> None:
+        if self._merger is not None and self._merger.is_alive():
+            return
+        self._merger = threading.Thread(target=self.merge, daemon=True)
+        self._merger.start()
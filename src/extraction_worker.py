@@ -0,0 +1,95 @@
+"""
+A long-lived extraction worker keeping the `marker` models resident, so short CLI invocations do not reload them.
+
+Start it once per host, with the same output directory as the agent:
+
+```sh
+python -m src.extraction_worker --address /tmp/paper-agent-extractor.sock --output-dir outputs
+```
+
+and set `extractor.worker_address` to the same socket path. Jobs are PDF paths sent over the unix socket, one at a time per connection, the replies are the `ExtractorOutput`s.
+"""
+
+import argparse
+
+from pathlib import Path
+from multiprocessing.connection import Client, Listener
+
+from src.logger import get_logger
+from src.cfg_mappings import ExtractorConfigs
+from src.types.agent_info import ExtractorOutput
+
+# The socket is only reachable by users allowed to open its file, the key
+# guards against talking to an unrelated listener by mistake
+_AUTHKEY = b"paper-agent-extractor"
+
+
+class ExtractionClient:
+
+    def __init__(self, address: str) -> None:
+        self.address = address
+
+    def is_available(self) -> bool:
+        if not Path(self.address).exists():
+            return False
+        try:
+            Client(self.address, family="AF_UNIX", authkey=_AUTHKEY).close()
+        except (ConnectionError, FileNotFoundError):
+            return False
+        return True
+
+    def convert_pdf_to_markdown(self, pdf_path: Path) -> ExtractorOutput:
+        with Client(self.address, family="AF_UNIX", authkey=_AUTHKEY) as conn:
+            conn.send(str(Path(pdf_path).resolve()))
+            status, payload = conn.recv()
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+
+def serve(extractor_cfgs: ExtractorConfigs, address: str) -> None:
+    # Imported here, `src.pdf_extractor` itself depends on the client above
+    from src.pdf_extractor import PDFExtractor
+
+    logger = get_logger(__name__)
+    extractor = PDFExtractor(extractor_cfgs)
+    # Load the models now rather than on the first job
+    extractor.pdf_converter
+
+    Path(address).unlink(missing_ok=True)
+    with Listener(address, family="AF_UNIX", authkey=_AUTHKEY) as listener:
+        logger.info(f"Extraction worker listening on {address}")
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        pdf_path = conn.recv()
+                    except EOFError:
+                        break
+                    try:
+                        output = extractor.convert_pdf_to_markdown(Path(pdf_path))
+                        conn.send(("ok", output))
+                        extractor.image_writer.flush()
+                    except Exception as e:
+                        logger.warning(f"Failed to convert PDF {pdf_path}: {e}")
+                        conn.send(("error", f"{e.__class__.__name__}: {e}"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--address", required=True, help="Unix socket path.")
+    parser.add_argument("--output-dir", default="outputs", help="Output directory.")
+    args = parser.parse_args()
+    serve(
+        ExtractorConfigs(
+            temperature=0.0,
+            prompt_file="",
+            num_pdf_concurrent=1,
+            output_dir=args.output_dir,
+        ),
+        args.address,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import fcntl
+
+from contextlib import contextmanager
+from typing import Iterator, Union
+from pathlib import Path
+
+
+class FileLock:
+    """
+    An exclusive lock shared by all the processes opening the same `path`, through `flock`.
+
+    Every acquisition opens its own file description, so two threads of one process exclude each other as well. It is not reentrant.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        with open(self.path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,61 @@
+import json
+import hashlib
+
+from typing import Any, Optional, Union
+from pathlib import Path
+
+
+class FingerprintIndex:
+    """
+    Content fingerprints of the extracted PDFs, used to decide whether a file needs to be (re-)extracted and (re-)embedded.
+
+    Two maps are persisted in `path`:
+
+    - `paths`: resolved file path -> `{"size", "mtime_ns", "sha256"}`, the fast path: a file whose size and mtime did not change is not hashed again.
+    - `contents`: sha256 -> what was produced from that content (`pdf_name`, `meta_file`, ...), so a renamed file is recognized and a changed file with the same name is not.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._paths: dict[str, dict[str, Any]] = {}
+        self._contents: dict[str, dict[str, Any]] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                contents = json.load(f)
+            self._paths = contents.get("paths", {})
+            self._contents = contents.get("contents", {})
+
+    def fingerprint(self, file: Path) -> str:
+        """
+        The sha256 of `file`, only hashed when its size or mtime changed since the last call.
+        """
+        key = str(Path(file).resolve())
+        stat = Path(file).stat()
+        entry = self._paths.get(key)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return entry["sha256"]
+        with open(file, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        self._paths[key] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest,
+        }
+        return digest
+
+    def lookup(self, file: Path) -> Optional[dict[str, Any]]:
+        """
+        What was produced from the content of `file`, or None if this content was never extracted.
+        """
+        return self._contents.get(self.fingerprint(file))
+
+    def record(self, file: Path, **outputs: Any) -> None:
+        self._contents[self.fingerprint(file)] = outputs
+
+    def save(self) -> None:
+        with open(self.path, "w") as f:
+            json.dump({"paths": self._paths, "contents": self._contents}, f, indent=4)
@@ -0,0 +1,141 @@
+import re
+import numpy as np
+
+from typing import Callable, Optional
+from pathlib import Path
+from itertools import groupby
+
+from src.chunker import estimate_tokens
+from src.history_store import HistoryStore
+from src.types.agent_info import Conversation
+
+_SENTENCE_END_RE = re.compile(r"[.!?。！？]\s")
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    The beginning of `text` within `max_tokens` estimated tokens, cut after a sentence if possible, else after a word.
+    """
+    text = " ".join(text.split())
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    head = text[:max_chars]
+    ends = [m.end() for m in _SENTENCE_END_RE.finditer(head)]
+    if ends and ends[-1] > max_chars // 2:
+        return head[: ends[-1]].rstrip()
+    cut = head.rfind(" ")
+    return (head[:cut] if cut > max_chars // 2 else head) + " ..."
+
+
+class HistoryCompressor:
+    """
+    Summaries of the rounds that fell out of the history window, so a long chat does not paste its whole history into the prompt.
+
+    A round leaving the window is summarized extractively (the beginning of each of its conversations, `summary_tokens` in total, no LLM call on the request path) and its summary embedded. The summaries are kept in their own `HistoryStore` as conversations with `summary` and `embeddings` set. For each query, the summaries most similar to it are put back in the prompt, up to `budget_tokens` estimated tokens, in chronological order.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        embed: Callable[[list[str]], np.ndarray],
+        summary_tokens: int = 96,
+        budget_tokens: int = 512,
+        separator: str = "\n",
+    ) -> None:
+        self.embed = embed
+        self.summary_tokens = summary_tokens
+        self.budget_tokens = budget_tokens
+        self.store = HistoryStore(path, separator=separator)
+
+        self._summaries = self.store.read(0, len(self.store))
+        self._embeddings = (
+            np.array([s.embeddings for s in self._summaries], dtype=np.float32)
+            if self._summaries
+            else None
+        )
+
+    @property
+    def has_summaries(self) -> bool:
+        return self._embeddings is not None
+
+    @property
+    def last_round(self) -> int:
+        """
+        The last summarized round, -1 if none.
+        """
+        return self._summaries[-1].round_id if self._summaries else -1
+
+    def summarize(self, conversations: list[Conversation]) -> str:
+        """
+        An extractive summary of a round: the first `summary_tokens` estimated tokens, shared by its conversations, of each of their contents. It is not an abstract of the whole round.
+        """
+        tokens = max(self.summary_tokens // max(len(conversations), 1), 1)
+        return " ".join(
+            f"{'User' if conv.role == 'user' else 'Assistant'}: "
+            f"{truncate_to_tokens(conv.content, tokens)}"
+            for conv in conversations
+        )
+
+    def update(self, history: HistoryStore, window_start: int) -> None:
+        """
+        Summarize the rounds of `history` before round `window_start` not summarized yet, only those are read.
+        """
+        if window_start <= self.last_round + 1:
+            return
+        conversations = [
+            conv
+            for conv in history.read_rounds(self.last_round + 1)
+            if conv.round_id < window_start
+        ]
+        rounds = [
+            list(convs)
+            for _, convs in groupby(conversations, key=lambda conv: conv.round_id)
+        ]
+        if not rounds:
+            return
+
+        summaries = [self.summarize(convs) for convs in rounds]
+        embeddings = np.asarray(self.embed(summaries), dtype=np.float32)
+        for convs, summary, embedding in zip(rounds, summaries, embeddings):
+            record = Conversation(
+                conversation_id=convs[0].conversation_id,
+                round_id=convs[0].round_id,
+                timestamp=convs[0].timestamp,
+                role=convs[0].role,
+                content="",
+                file_refs=sorted({ref for conv in convs for ref in conv.file_refs}),
+                summary=summary,
+                embeddings=embedding.tolist(),
+            )
+            self.store.append(record)
+            self._summaries.append(record)
+        self._embeddings = (
+            embeddings
+            if self._embeddings is None
+            else np.concatenate([self._embeddings, embeddings])
+        )
+
+    def relevant(self, query_embedding: np.ndarray) -> list[Conversation]:
+        """
+        The summaries most similar to the query that fit in `budget_tokens`, in chronological order.
+        """
+        if self._embeddings is None or self.budget_tokens <= 0:
+            return []
+        scores = self._embeddings @ np.asarray(query_embedding, dtype=np.float32)
+        selected, used = [], 0
+        for i in np.argsort(-scores):
+            tokens = estimate_tokens(self._summaries[i].summary)
+            if used + tokens > self.budget_tokens:
+                continue
+            selected.append(int(i))
+            used += tokens
+        return [self._summaries[i] for i in sorted(selected)]
+
+    def to_message(self, summaries: list[Conversation]) -> Optional[dict[str, str]]:
+        if not summaries:
+            return None
+        contents = "## Earlier Conversation\n\n" + "\n\n".join(
+            f"Round {s.round_id}: {s.summary}" for s in summaries
+        )
+        return {"role": "system", "content": contents}
@@ -0,0 +1,120 @@
+import os
+import json
+import struct
+import threading
+
+from dataclasses import asdict
+from typing import Union
+from pathlib import Path
+
+from src.types.agent_info import Conversation
+
+
+class HistoryStore:
+    """
+    The conversations of a chat, one JSON record per line in `path`, with a sidecar index `<path>.idx` of fixed-size `(round_id, byte offset)` entries, one per record.
+
+    Loading the last records seeks to their offset and reads only them, so it costs O(window) whatever the length of the chat. Records are appended to the history before their index entry: records left without one by a crash are indexed again when the store is opened, by reading the tail only. A history without an index (or an index pointing past the history) is indexed from scratch once.
+    """
+
+    _ENTRY = struct.Struct("<qq")
+
+    def __init__(self, path: Union[str, Path], separator: str = "\n") -> None:
+        self.path = Path(path)
+        self.index_path = self.path.with_name(f"{self.path.name}.idx")
+        self.separator = separator
+        self._lock = threading.Lock()
+        with self._lock:
+            self._sync_index()
+
+    def __len__(self) -> int:
+        if not self.index_path.exists():
+            return 0
+        return self.index_path.stat().st_size // self._ENTRY.size
+
+    def _entries(self, start: int, end: int) -> list[tuple[int, int]]:
+        with open(self.index_path, "rb") as f:
+            f.seek(start * self._ENTRY.size)
+            data = f.read((end - start) * self._ENTRY.size)
+        return list(self._ENTRY.iter_unpack(data))
+
+    def _history_size(self) -> int:
+        return self.path.stat().st_size if self.path.exists() else 0
+
+    def _sync_index(self) -> None:
+        size = self._history_size()
+        num_entries = len(self)
+        offset = 0
+        if num_entries:
+            _, offset = self._entries(num_entries - 1, num_entries)[0]
+            if offset >= size:
+                # The history was truncated or replaced, index it again
+                os.truncate(self.index_path, 0)
+                num_entries, offset = 0, 0
+        if offset >= size:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        separator = self.separator.encode("utf-8")
+        entries = []
+        position = offset
+        for i, line in enumerate(data.split(separator)[:-1]):
+            # The first record is the last indexed one, if any
+            if i or not num_entries:
+                record = json.loads(line)
+                entries.append(self._ENTRY.pack(record["round_id"], position))
+            position += len(line) + len(separator)
+        if position < size:
+            # A record torn by a crash while appending
+            os.truncate(self.path, position)
+        with open(self.index_path, "ab") as f:
+            f.write(b"".join(entries))
+
+    def append(self, conversation: Conversation) -> None:
+        line = (json.dumps(asdict(conversation)) + self.separator).encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+            with open(self.index_path, "ab") as f:
+                f.write(self._ENTRY.pack(conversation.round_id, offset))
+
+    def read(self, start: int, end: int) -> list[Conversation]:
+        """
+        The records `[start, end)`, in order.
+        """
+        with self._lock:
+            num_entries = len(self)
+            start, end = max(start, 0), min(end, num_entries)
+            if start >= end:
+                return []
+            entries = self._entries(start, min(end + 1, num_entries))
+            first = entries[0][1]
+            last = entries[-1][1] if end < num_entries else self._history_size()
+            with open(self.path, "rb") as f:
+                f.seek(first)
+                data = f.read(last - first)
+        lines = data.decode("utf-8").split(self.separator)[: end - start]
+        return [Conversation(**json.loads(line)) for line in lines]
+
+    def tail(self, n: int) -> list[Conversation]:
+        """
+        The last `n` records.
+        """
+        num_entries = len(self)
+        return self.read(num_entries - n, num_entries)
+
+    def read_rounds(self, first_round: int) -> list[Conversation]:
+        """
+        The records from round `first_round` on, found by a binary search over the index (round ids never decrease).
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entries(mid, mid + 1)[0][0] < first_round:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self.read(lo, len(self))
@@ -0,0 +1,93 @@
+import io
+import os
+import queue
+import atexit
+import logging
+import threading
+
+from typing import Optional
+from pathlib import Path
+from PIL import Image
+
+
+class ImageWriter:
+    """
+    Encodes and writes images in background threads, so the caller does not wait for the PNG/WebP encoding.
+
+    At most `max_pending` images wait in the queue, `submit` blocks beyond that to bound memory. A file that already holds the same bytes is not rewritten. Call `flush` before relying on the files being on disk, pending images are also flushed at interpreter exit (not in `multiprocessing` children, they have to flush explicitly).
+
+    `image_format` re-encodes the images (e.g. "webp" or "png"), `None` keeps the format given by the file suffix. `compress_level` (0-9) applies to PNG, `quality` (0-100) to WebP and JPEG.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        num_workers: int = 2,
+        max_pending: int = 64,
+        image_format: Optional[str] = None,
+        compress_level: int = 6,
+        quality: int = 90,
+    ) -> None:
+        self.logger = logger
+        self.image_format = image_format.lower() if image_format else None
+        self.compress_level = compress_level
+        self.quality = quality
+
+        self._queue: queue.Queue[tuple[Image.Image, Path]] = queue.Queue(max_pending)
+        for _ in range(max(num_workers, 1)):
+            threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def target_path(self, path: Path) -> Path:
+        """
+        Where the image for `path` is written, the suffix follows `image_format`.
+        """
+        if self.image_format is None:
+            return path
+        return path.with_suffix(f".{self.image_format}")
+
+    def submit(self, image: Image.Image, path: Path) -> Path:
+        path = self.target_path(path)
+        self._queue.put((image, path))
+        return path
+
+    def flush(self) -> None:
+        self._queue.join()
+
+    def _encode(self, image: Image.Image, path: Path) -> bytes:
+        image_format = Image.registered_extensions().get(path.suffix.lower())
+        if image_format is None:
+            raise ValueError(f"Unknown image format for {path}")
+        params = {}
+        if image_format == "PNG":
+            params["compress_level"] = self.compress_level
+        elif image_format in ("WEBP", "JPEG"):
+            params["quality"] = self.quality
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, **params)
+        return buffer.getvalue()
+
+    def _write(self, image: Image.Image, path: Path) -> None:
+        data = self._encode(image, path)
+        if (
+            path.exists()
+            and path.stat().st_size == len(data)
+            and path.read_bytes() == data
+        ):
+            return
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _run(self) -> None:
+        while True:
+            image, path = self._queue.get()
+            try:
+                self._write(image, path)
+            except Exception as e:
+                self.logger.warning(f"Failed to save image {path}: {e}")
+            finally:
+                self._queue.task_done()
@@ -1,12 +1,17 @@
 import os
+import time
 import logging
 
 from pathlib import Path
-from openai import OpenAI
+from typing import Optional, Union
 
 from src.singleton import singleton
+from src.llm_client import get_client
+from src.cfg_mappings import ClientConfigs
+from src.prompt_registry import PromptRegistry
 from src.debug_utils import variable_check
 
+
 @singleton
 class Launcher:
     """
@@ -39,6 +44,8 @@ class Launcher:
         api_key: str = "",
         base_url: str = "",
         chat_model: str = "",
+        stream: bool = True,
+        client: Optional[Union[ClientConfigs, dict]] = None,
     ) -> None:
         self.logger = logging.getLogger(__name__)
 
@@ -49,8 +56,15 @@ class Launcher:
         self.output_dir = Path(output_dir)
         self._init_env()
 
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        # Shared with the other components talking to the same endpoint
+        if client is not None and not isinstance(client, ClientConfigs):
+            client = ClientConfigs(**client)
+        self.client = get_client(api_key, base_url, client)
         self.chat_model = chat_model
+        self.stream = stream
+        # Latency of the last streamed round: time to first token (s) and decoding speed (tokens/s)
+        self.last_round_stats: dict[str, float] = {}
+        self.prompts = PromptRegistry(self.prompt_dir)
         self.system_prompts = self._load_system_prompts()
 
     def _init_env(self) -> None:
@@ -78,24 +92,68 @@ class Launcher:
             raise RuntimeError(
                 f"Prompt files {self.prompt_dir} not found, please create the prompts directory and add prompts in markdown format."
             )
-        prompt_files = self.prompt_dir.glob("*.md")
-        system_prompts = ""
-        for p in prompt_files:
-            with open(p) as f:
-                system_prompts += f.read()
-                system_prompts += "\n"
+        # Read once, the prompts changed on disk are reloaded on the next rounds
+        system_prompts = self.prompts.join()
         if not system_prompts:
             self.logger.warning(f"system_prompts are loaded but are empty.")
         return system_prompts
 
-    def chat_single_round(self) -> None:
+    def chat_single_round(self) -> str:
+        self.system_prompts = self.prompts.join()
         variable_check(system_prompt=self.system_prompts)
         messages = [{"role": "system", "content": self.system_prompts}]
         user_inputs = input("User: ")
         messages.append({"role": "user", "content": user_inputs})
+        if not self.stream:
+            responses = self.client.chat.completions.create(
+                messages=messages,
+                model=self.chat_model,
+            )
+            answer = responses.choices[0].message.content
+            print(f"Agent: {answer}")
+            return answer
+        return self._stream_answer(messages)
+
+    def _stream_answer(self, messages: list[dict[str, str]]) -> str:
+        """
+        Print the answer as its tokens arrive, record the time to first token and the tokens per second, and return the whole answer.
+        """
+        start = time.perf_counter()
         responses = self.client.chat.completions.create(
             messages=messages,
             model=self.chat_model,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        agent_outputs = f"Agent: {responses.choices[0].message.content}"
-        print(agent_outputs)
+        print("Agent: ", end="", flush=True)
+        parts: list[str] = []
+        first_token, num_chunks, usage = None, 0, None
+        for chunk in responses:
+            # The usage comes in a last chunk without choices
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter()
+            num_chunks += 1
+            parts.append(chunk.choices[0].delta.content)
+            print(parts[-1], end="", flush=True)
+        print()
+        end = time.perf_counter()
+
+        if first_token is not None:
+            # A content chunk is about one token when the server reports no usage
+            num_tokens = usage.completion_tokens if usage is not None else num_chunks
+            decoding = end - first_token
+            self.last_round_stats = {
+                "time_to_first_token": first_token - start,
+                "total_time": end - start,
+                "completion_tokens": num_tokens,
+                "tokens_per_second": num_tokens / decoding if decoding > 0 else 0.0,
+            }
+            self.logger.info(
+                f"Time to first token {self.last_round_stats['time_to_first_token']:.2f}s, "
+                f"{self.last_round_stats['tokens_per_second']:.1f} tokens/s"
+            )
+        return "".join(parts)
@@ -0,0 +1,93 @@
+"""
+The OpenAI clients of the agent. They are created once and shared by the chat, the embeddings and the retrieval, so every request reuses one pool of keep-alive connections instead of opening its own.
+
+- `get_client`: the synchronous client, one per process.
+- `get_async_client`: the asynchronous client, one per event loop (the connections of an `httpx.AsyncClient` belong to the loop that opened them).
+"""
+
+import asyncio
+import threading
+import weakref
+
+from typing import Optional
+from openai import (
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+)
+from httpx import Limits, Timeout
+
+from src.cfg_mappings import ClientConfigs
+
+_lock = threading.Lock()
+# Keyed by `(api_key, base_url)`
+_clients: dict[tuple[str, str], OpenAI] = {}
+_async_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[tuple[str, str], AsyncOpenAI]
+] = weakref.WeakKeyDictionary()
+
+
+def _normalize_url(base_url: str) -> str:
+    # `OpenAI.base_url` is an `httpx.URL` with a trailing slash
+    return str(base_url).rstrip("/")
+
+
+def _pool_settings(cfgs: ClientConfigs) -> dict:
+    return {
+        "limits": Limits(
+            max_connections=cfgs.max_connections,
+            max_keepalive_connections=cfgs.max_keepalive_connections,
+        ),
+        "timeout": Timeout(cfgs.timeout, connect=cfgs.connect_timeout),
+    }
+
+
+def get_client(
+    api_key: str,
+    base_url: str,
+    cfgs: Optional[ClientConfigs] = None,
+) -> OpenAI:
+    """
+    The shared client of `(api_key, base_url)`, `cfgs` only applies to the first call creating it.
+    """
+    cfgs = cfgs or ClientConfigs()
+    key = (api_key, _normalize_url(base_url))
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            settings = _pool_settings(cfgs)
+            client = _clients[key] = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=settings["timeout"],
+                max_retries=cfgs.max_retries,
+                http_client=DefaultHttpxClient(**settings),
+            )
+    return client
+
+
+def get_async_client(
+    api_key: str,
+    base_url: str,
+    cfgs: Optional[ClientConfigs] = None,
+) -> AsyncOpenAI:
+    """
+    The shared asynchronous client of `(api_key, base_url)` in the running event loop, `cfgs` only applies to the first call creating it.
+    """
+    cfgs = cfgs or ClientConfigs()
+    key = (api_key, _normalize_url(base_url))
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            settings = _pool_settings(cfgs)
+            client = clients[key] = AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=settings["timeout"],
+                max_retries=cfgs.max_retries,
+                http_client=DefaultAsyncHttpxClient(**settings),
+            )
+    return client
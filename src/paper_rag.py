@@ -1,36 +1,83 @@
 """
-For this module, `faiss` is not used for both embedding and searching,
-this module provides an LLM based embedding and a cos-similarity based search methods.
+This module provides an LLM based embedding and a cos-similarity based search methods.
+The search is exact by default, or approximate through a `faiss` index (see `src.vector_index`).
 The embeddings are stored in vector_store, configured in `configs/`.
 """
 
+import os
+import time
+import atexit
+import asyncio
 import uuid
 import json
+import random
+import threading
 import numpy as np
 
-from openai import OpenAI
-from typing import Union
+from openai import (
+    AsyncOpenAI,
+    OpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from typing import Any, Iterable, Iterator, Optional, Union
 from pathlib import Path
-from sentence_transformers import SentenceTransformer
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from src.singleton import singleton
-from src.cfg_mappings import RAGConfigs
+from src.cfg_mappings import ClientConfigs, RAGConfigs
+from src.embedding_store import EmbeddingStore, MmapEmbeddingStore
+from src.embedding_cache import EmbeddingCache
+from src.query_cache import QueryCache
+from src.rwlock import RWLock
+from src.file_lock import FileLock
+from src.vector_index import (
+    FaissIndex,
+    FlatIndex,
+    ProductQuantizedIndex,
+    QuantizedIndex,
+    ScalarQuantizedIndex,
+)
+from src.bm25 import BM25Index, reciprocal_rank_fusion
+from src.chunker import MarkdownChunker, estimate_tokens
+from src.types.agent_info import DocumentChunk
+from src.llm_client import get_async_client
 from src.logger import get_logger
 
+# Errors worth retrying, anything else (bad request, auth) fails immediately
+_RETRYABLE_ERRORS = (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
 
 @singleton
 class PaperRAG:
 
-    def __init__(self, cfgs: RAGConfigs, client: OpenAI) -> None:
+    # Embedding batches of a streamed document waiting to be added to the store
+    _MAX_IN_FLIGHT = 2
+
+    def __init__(
+        self,
+        cfgs: RAGConfigs,
+        client: OpenAI,
+        client_cfgs: Optional[ClientConfigs] = None,
+    ) -> None:
 
         self.logger = get_logger(__name__)
 
-        self._embeddings = []
         self._chunks = []
         self._ids = []
+        self._deleted_rows: set[int] = set()
 
         self.num_chunks = cfgs.num_chunks
         self.overlap = cfgs.overlap
+        self._chunker = MarkdownChunker(self.num_chunks, self.overlap)
         self.topk = cfgs.topk
 
         self.store_dir = Path(cfgs.store_dir)
@@ -39,89 +86,998 @@ class PaperRAG:
         self.embed_file = self.store_dir / cfgs.embed_file
 
         self.client = client
+        # Pool settings of the asynchronous client (`Configs.client`), the synchronous one is given
+        self.client_cfgs = client_cfgs
         self.embedding_name = cfgs.embedding_model
         self.embedding_dim = cfgs.embed_dim
+        self.storage = cfgs.storage
+        self.quantization = cfgs.quantization
+        if self.quantization is not None and self.storage != "mmap":
+            # The float32 rows are only read to re-score, keep them on disk
+            self.logger.info(
+                f"Quantization {self.quantization} keeps the embeddings memory-mapped."
+            )
+            self.storage = "mmap"
+        self.merge_threshold = cfgs.merge_threshold
+        self.embed_batch_size = cfgs.embed_batch_size
+        self.embed_batch_tokens = cfgs.embed_batch_tokens
+        self.embed_concurrency = cfgs.embed_concurrency
+        self.embed_max_retries = cfgs.embed_max_retries
+        self.embed_backoff = cfgs.embed_backoff
+        self.cache = (
+            EmbeddingCache(
+                self.store_dir / cfgs.embed_cache_file,
+                max_bytes=cfgs.embed_cache_max_mb * 1024 * 1024,
+            )
+            if cfgs.embed_cache_file
+            else None
+        )
+        # Number of rows persisted, the rows after it are appended by the next `_persist`
+        self._num_saved = 0
+        # Bumped whenever rows are added or reloaded, cached search results of older versions are stale
+        self.version = 0
+        # Searches read the in-memory state together, changing it is exclusive
+        self._rwlock = RWLock()
+        # Taken by the changes to the store in this process (adding rows, persisting, reloading)
+        # for their whole duration, they only hold `_rwlock` to swap in their results
+        self._write_lock = threading.Lock()
+        # Held by the process writing the store files, across processes
+        self._file_lock = FileLock(self.store_dir / ".lock")
 
-        # Load existing metadata and embeddings if available
-        if self.meta_file.exists():
-            self._load_meta()
-        if self.embed_file.exists():
-            self._load_embeddings()
+        self.index_cfgs = cfgs
+        if self.quantization == "int8":
+            self._index_suffix = ".int8"
+        elif self.quantization is not None:
+            self._index_suffix = f".{self.quantization}.faiss"
+        else:
+            self._index_suffix = f".{cfgs.index_backend}.faiss"
+        self.compact_ratio = cfgs.compact_ratio
+        self._generation = 0
 
-    def _load_meta(self) -> None:
-        with open(self.meta_file, "r") as f:
-            contents = json.load(f)
-        self._ids = contents.keys()
-        self._chunks = [contents[k]["chunk"] for k in self._ids]
+        # Lexical index, only built when the retrieval uses it
+        self.retrieval = cfgs.retrieval
+        self.rrf_k = cfgs.rrf_k
+        self.bm25_k1 = cfgs.bm25_k1
+        self.bm25_b = cfgs.bm25_b
 
-    def _save_meta(self) -> None:
-        contents = {
-            k: {"chunk": self._chunks[i], "chunk_id": k}
-            for i, k in enumerate(self._ids)
+        # Load existing metadata and embeddings if available, the state is taken
+        # before reading so that a write made meanwhile is picked up by `refresh`
+        self._disk_state = self._file_state()
+        self._install(self._read_store())
+
+        self.query_cache = (
+            QueryCache(cfgs.query_cache_size, cfgs.query_cache_similarity)
+            if cfgs.query_cache_size > 0
+            else None
+        )
+        self.query_cache_file = (
+            self.store_dir / cfgs.query_cache_file if cfgs.query_cache_file else None
+        )
+        if self.query_cache is not None and self.query_cache_file is not None:
+            self.query_cache.load(
+                self.query_cache_file, self.store_signature, self.version
+            )
+            atexit.register(self.save_query_cache)
+
+    @property
+    def store_signature(self) -> str:
+        """
+        Identifies the persisted rows across processes: rows are only appended or deleted, and the ids are random.
+        """
+        return (
+            f"{self._generation}:{len(self._ids)}:{self._ids[-1] if self._ids else 0}"
+            f":{len(self._deleted_rows)}"
+        )
+
+    def save_query_cache(self) -> None:
+        if self.query_cache is not None and self.query_cache_file is not None:
+            self.query_cache.save(
+                self.query_cache_file, self.store_signature, self.version
+            )
+
+    @property
+    def index_file(self) -> Path:
+        return self._generation_files(self._generation)[1]
+
+    @property
+    def bm25_file(self) -> Path:
+        return self._generation_files(self._generation)[2]
+
+    def _generation_files(self, generation: int) -> tuple[Path, Path, Path]:
+        """
+        The embeddings, search index and BM25 snapshot files of a generation of the store (see `_compact`), the generation 0 being `embed_file` itself.
+        """
+        embed_file = (
+            self.embed_file
+            if generation == 0
+            else self.embed_file.with_name(
+                f"{self.embed_file.stem}.{generation}{self.embed_file.suffix}"
+            )
+        )
+        return (
+            embed_file,
+            embed_file.with_suffix(self._index_suffix),
+            embed_file.with_suffix(".bm25.npz"),
+        )
+
+    def _file_state(self) -> Optional[tuple[int, int, int]]:
+        """
+        `(inode, size, mtime)` of the metadata file. The metadata is the commit point of the rows, any write to the store changes it.
+        """
+        try:
+            stat = self.meta_file.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def refresh(self) -> bool:
+        """
+        Reload the store if another process modified its files since it was loaded or last persisted here, returns whether it was reloaded.
+
+        Checking costs two `stat` calls, the store is only re-read when it actually changed. It is read aside while the searches go on, they only wait for the new state to be swapped in. A write in progress in this process is not waited for: it reloads the store itself before writing, the current state is kept meanwhile.
+        """
+        if self._file_state() == self._disk_state:
+            return False
+        if not self._write_lock.acquire(blocking=False):
+            return False
+        try:
+            # Taken before reading, a change made during the reload is picked up next time
+            state = self._file_state()
+            if state == self._disk_state:
+                return False
+            self.logger.info(f"{self.meta_file} changed on disk, reloading the store.")
+            self._reload()
+            self._disk_state = state
+        finally:
+            self._write_lock.release()
+        return True
+
+    def _reload(self) -> None:
+        """
+        Re-read the store from disk and swap it in, the rows added in this process and not persisted yet are added back after the reloaded ones. The caller holds `_write_lock`, the searches are only held back for the swap.
+        """
+        start = self._num_saved
+        vectors = np.array(
+            self._store.pending
+            if self.storage == "mmap"
+            else self._store.vectors[start:]
+        )
+        uids, chunk_infos = self._ids[start:], self._chunks[start:]
+        deleted = self._pending_deletes
+        state = self._read_store()
+        with self._rwlock.write():
+            self._install(state)
+            if uids:
+                self._append_rows(vectors, uids, chunk_infos)
+            if deleted:
+                rows = {uid: row for row, uid in enumerate(self._ids)}
+                self._delete_rows([rows[uid] for uid in deleted if uid in rows])
+
+    def _install(self, state: dict[str, Any]) -> None:
+        """
+        Swap in a state read by `_read_store`. The caller holds the write lock.
+        """
+        signature = self.store_signature
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.store_signature != signature:
+            self.version += 1
+
+    def _read_store(self) -> dict[str, Any]:
+        """
+        The store as persisted on disk: the metadata paired with the embeddings (a base matrix plus an append-only segment, see `MmapEmbeddingStore`), the lexical and the search indices. Everything is read into new objects, the state being searched is not touched, and the files are not modified.
+
+        Rows past the committed metadata are not exposed, metadata without rows is dropped in memory.
+        """
+        ids, chunks, deleted_rows, meta_bytes, generation = self._read_meta()
+        embed_file = self._generation_files(generation)[0]
+        for _ in range(3):
+            if generation == 0 or embed_file.exists():
+                break
+            # Compacted again by another process since the metadata was read, its files are gone
+            ids, chunks, deleted_rows, meta_bytes, generation = self._read_meta()
+            embed_file = self._generation_files(generation)[0]
+        disk = MmapEmbeddingStore(
+            embed_file,
+            self.embedding_dim,
+            self.merge_threshold,
+            lock=self._file_lock,
+        )
+        num_rows = len(disk)
+        n = min(num_rows, len(ids))
+        if num_rows > n:
+            # Being appended by a writer before their metadata, or left by a crash
+            disk.limit(n)
+        if len(ids) > n:
+            self.logger.warning(
+                f"{len(ids)} chunks but {num_rows} embeddings found, "
+                f"only the first {n} are kept."
+            )
+            ids, chunks = ids[:n], chunks[:n]
+            deleted_rows = {row for row in deleted_rows if row < n}
+            meta_bytes = None
+
+        if self.storage == "mmap":
+            store = disk
+        else:
+            # The rows are loaded in RAM, the disk store is only used to append to the files
+            store = EmbeddingStore(self.embedding_dim, capacity=n)
+            if n:
+                store.add(disk.vectors, ids)
+        bm25, bm25_saved = self._read_lexical(chunks, generation)
+        return {
+            "_generation": generation,
+            "_ids": ids,
+            "_chunks": chunks,
+            "_deleted_rows": deleted_rows,
+            # Tombstones not persisted yet
+            "_pending_deletes": [],
+            # Bytes of the committed lines, None if the file has to be rewritten
+            "_meta_bytes": meta_bytes,
+            "_store": store,
+            "_disk": disk,
+            "_num_saved": n,
+            "_doc_rows": self._document_ranges(chunks, deleted_rows),
+            "_bm25": bm25,
+            "_bm25_saved": bm25_saved,
+            "_index": self._read_index(store, generation),
         }
-        with open(self.meta_file, "w") as f:
-            json.dump(contents, f, indent=4)
 
-    def _load_embeddings(self) -> None:
-        self._embeddings = np.load(self.embed_file).tolist()
+    def _read_meta(
+        self,
+    ) -> tuple[list[int], list[dict], set[int], Optional[int], int]:
+        """
+        Read the chunk metadata, one JSON line `{"chunk_id", "chunk"}` per row of the embeddings, and the tombstones `{"deleted": [chunk_id, ...]}` of the rows of replaced documents. A compacted store starts with its generation `{"generation": n}`. Returns the ids, the chunks, the deleted rows, the bytes of the committed lines and the generation.
+
+        Only complete lines are committed: a torn last line (a writer still appending it, or a crash) is ignored here and cut off by the next writer, see `_repair`. A metadata file in the former single JSON object format is converted in memory and rewritten by the next writer (None bytes).
+        """
+        ids, chunks = [], []
+        if not self.meta_file.exists():
+            return ids, chunks, set(), 0, 0
+        with open(self.meta_file, "rb") as f:
+            data = f.read()
+
+        try:
+            contents = json.loads(data)
+        except json.JSONDecodeError:
+            contents = None
+        if isinstance(contents, dict) and not contents.keys() & {
+            "chunk_id",
+            "deleted",
+            "generation",
+        }:
+            ids = [int(k) for k in contents.keys()]
+            chunks = [contents[k]["chunk"] for k in contents.keys()]
+            return ids, chunks, set(), None, 0
+
+        deleted, meta_bytes, generation = set(), 0, 0
+        for line in data.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if "deleted" in record:
+                deleted.update(record["deleted"])
+            elif "generation" in record:
+                generation = record["generation"]
+            else:
+                ids.append(int(record["chunk_id"]))
+                chunks.append(record["chunk"])
+            meta_bytes += len(line)
+        deleted_rows = (
+            {row for row, uid in enumerate(ids) if uid in deleted} if deleted else set()
+        )
+        return ids, chunks, deleted_rows, meta_bytes, generation
+
+    def _meta_header(self) -> bytes:
+        if self._generation == 0:
+            return b""
+        return (json.dumps({"generation": self._generation}) + "\n").encode("utf-8")
+
+    def _meta_lines(self, start: int, end: int) -> bytes:
+        return "".join(
+            json.dumps({"chunk_id": self._ids[i], "chunk": self._chunks[i]}) + "\n"
+            for i in range(start, end)
+        ).encode("utf-8")
+
+    def _rewrite_meta(self) -> None:
+        """
+        Compact the metadata into a new file holding exactly the persisted rows and tombstones.
+        """
+        data = self._meta_header() + self._meta_lines(0, self._num_saved)
+        pending = set(self._pending_deletes)
+        deleted = [
+            self._ids[row]
+            for row in sorted(self._deleted_rows)
+            if row < self._num_saved and self._ids[row] not in pending
+        ]
+        if deleted:
+            data += (json.dumps({"deleted": deleted}) + "\n").encode("utf-8")
+        tmp_file = self.meta_file.with_name(f"{self.meta_file.name}.tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.meta_file)
+        self._meta_bytes = len(data)
+
+    def _compact(self) -> None:
+        """
+        Rewrite the store without its deleted rows. The caller holds `_write_lock` and the file lock, and everything is persisted.
+
+        The rows are renumbered, so the embeddings and indices of the kept rows are written into the files of a new generation, next to the current ones. Replacing the metadata, which names its generation, commits them. The files of the former generation are removed afterwards: the processes that mapped them keep valid mappings, and one that read the former metadata but finds its files gone reads the metadata again.
+        """
+        keep = np.setdiff1d(
+            np.arange(len(self._ids)), np.fromiter(self._deleted_rows, dtype=np.int64)
+        )
+        former, generation = self._generation, self._generation + 1
+        embed_file, index_file, bm25_file = self._generation_files(generation)
+        self.logger.info(
+            f"Compacting the store: {len(self._deleted_rows)} deleted rows dropped, "
+            f"{len(keep)} kept in {embed_file.name}."
+        )
+        self._disk.write_rows(keep, embed_file)
+        store = MmapEmbeddingStore(embed_file, self.embedding_dim)
+        index = self._create_index(store)
+        if not isinstance(index, FlatIndex):
+            index.build(store.vectors)
+            if index.is_ready:
+                index.save(index_file)
+        if self._bm25 is not None:
+            bm25 = BM25Index(k1=self.bm25_k1, b=self.bm25_b)
+            bm25.add([self._chunks[row]["chunk"] for row in keep])
+            bm25.save(bm25_file)
+
+        data = (json.dumps({"generation": generation}) + "\n").encode("utf-8") + (
+            "".join(
+                json.dumps({"chunk_id": self._ids[row], "chunk": self._chunks[row]})
+                + "\n"
+                for row in keep
+            ).encode("utf-8")
+        )
+        tmp_file = self.meta_file.with_name(f"{self.meta_file.name}.tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.meta_file)
+
+        embed_file, index_file, bm25_file = self._generation_files(former)
+        for path in (embed_file, embed_file.with_suffix(".seg"), index_file, bm25_file):
+            path.unlink(missing_ok=True)
+        self._reload()
+
+    def _save_meta(self) -> None:
+        # The tombstones after the rows: a torn write keeps the old version of a
+        # replaced document rather than losing both
+        data = self._meta_lines(self._num_saved, len(self._ids))
+        if self._meta_bytes == 0:
+            data = self._meta_header() + data
+        if self._pending_deletes:
+            data += (json.dumps({"deleted": self._pending_deletes}) + "\n").encode(
+                "utf-8"
+            )
+        with open(self.meta_file, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._meta_bytes += len(data)
+        self._pending_deletes = []
+
+    def _repair(self) -> None:
+        """
+        Cut off what lies past the persisted rows on disk: embeddings without metadata and a torn metadata line. The caller holds the store lock, no other process is writing them.
+        """
+        self._disk.truncate(self._num_saved)
+        if self._meta_bytes is None:
+            self.logger.info(f"Rewriting {self.meta_file} as JSON lines")
+            self._rewrite_meta()
+        elif (
+            self.meta_file.exists() and self.meta_file.stat().st_size > self._meta_bytes
+        ):
+            self.logger.warning(
+                f"Cutting off a torn record at the end of {self.meta_file}"
+            )
+            os.truncate(self.meta_file, self._meta_bytes)
 
     def _save_embeddings(self) -> None:
-        np.save(self.embed_file, np.array(self._embeddings, dtype=np.float32))
+        if self.storage == "mmap":
+            self._store.save()
+        else:
+            rows = slice(self._num_saved, len(self._store))
+            self._disk.add(self._store.vectors[rows], self._store.ids[rows])
+            self._disk.save()
+
+    def _persist(self) -> None:
+        """
+        Append the rows added since the last call, so persisting costs time proportional to the new rows only.
+
+        The embeddings are appended and synced before their metadata: a row is committed once its metadata line is written, readers ignore anything past it. The processes writing the store take turns on a lock file. Under it, a store changed by another process since it was loaded here is reloaded first, and the leftovers of a crashed writer are cut off (see `_repair`). The searches go on meanwhile, only appending to the searched embeddings holds them back.
+        """
+        with self._write_lock:
+            if self._num_saved == len(self._ids) and not self._pending_deletes:
+                return
+            with self._file_lock.exclusive():
+                if self._file_state() != self._disk_state:
+                    self._reload()
+                with self._rwlock.write():
+                    self._repair()
+                    self._save_embeddings()
+                self._save_meta()
+                self._num_saved = len(self._ids)
+                self.save_index()
+                # The chunks are the log of the lexical index, its snapshot is only
+                # rewritten once enough rows were appended since the last one
+                if (
+                    self._bm25 is not None
+                    and len(self._bm25) - self._bm25_saved >= self.merge_threshold
+                ):
+                    self._bm25.save(self.bm25_file)
+                    self._bm25_saved = len(self._bm25)
+                if self._deleted_rows and len(
+                    self._deleted_rows
+                ) >= self.compact_ratio * len(self._ids):
+                    self._compact()
+                # Our own writes do not call for a reload
+                self._disk_state = self._file_state()
+
+    def _read_lexical(
+        self, chunks: list[dict], generation: int
+    ) -> tuple[Optional[BM25Index], int]:
+        """
+        The BM25 snapshot caught up with the `chunks` appended since it was saved, and the number of rows in the snapshot. None if the retrieval does not use it.
+        """
+        if self.retrieval == "dense":
+            return None, 0
+        bm25 = BM25Index(k1=self.bm25_k1, b=self.bm25_b)
+        bm25_file = self._generation_files(generation)[2]
+        if bm25_file.exists():
+            bm25.load(bm25_file)
+        if len(bm25) > len(chunks):
+            # The snapshot has rows dropped since, rebuild
+            bm25 = BM25Index(k1=self.bm25_k1, b=self.bm25_b)
+        saved = len(bm25)
+        bm25.add([c["chunk"] for c in chunks[saved:]])
+        return bm25, saved
+
+    def _create_index(
+        self, store: Union[EmbeddingStore, MmapEmbeddingStore]
+    ) -> Union[FlatIndex, FaissIndex, QuantizedIndex]:
+        if self.quantization is not None:
+            if self.index_cfgs.index_backend != "flat":
+                raise ValueError(
+                    f"Quantization {self.quantization} replaces the flat index, "
+                    f"it can not be used with index backend {self.index_cfgs.index_backend}"
+                )
+            if self.quantization == "int8":
+                return ScalarQuantizedIndex(
+                    store, rescore_factor=self.index_cfgs.rescore_factor
+                )
+            if self.quantization == "pq":
+                return ProductQuantizedIndex(
+                    store,
+                    pq_m=self.index_cfgs.pq_m,
+                    rescore_factor=self.index_cfgs.rescore_factor,
+                )
+            raise ValueError(f"Unknown quantization: {self.quantization}")
+        if self.index_cfgs.index_backend == "flat":
+            return FlatIndex(store)
+        return FaissIndex(
+            self.embedding_dim,
+            backend=self.index_cfgs.index_backend,
+            nlist=self.index_cfgs.ivf_nlist,
+            nprobe=self.index_cfgs.ivf_nprobe,
+            hnsw_m=self.index_cfgs.hnsw_m,
+            ef_construction=self.index_cfgs.hnsw_ef_construction,
+            ef_search=self.index_cfgs.hnsw_ef_search,
+        )
+
+    def _read_index(
+        self, store: Union[EmbeddingStore, MmapEmbeddingStore], generation: int
+    ) -> Union[FlatIndex, FaissIndex, QuantizedIndex]:
+        """
+        The search index of `store` persisted next to `embed_file`. The index ids are the row numbers and rows are only appended: an index behind the embeddings (saved before rows were added, or a writer between its metadata and its index) catches up with the missing rows. It is only rebuilt if it is missing or ahead of the embeddings.
+        """
+        index = self._create_index(store)
+        if isinstance(index, FlatIndex):
+            return index
+        index_file = self._generation_files(generation)[1]
+        if index_file.exists():
+            index.load(index_file)
+        if index.is_ready and len(index) <= len(store):
+            if len(index) < len(store):
+                index.add(store.rows_from(len(index)))
+        elif len(store) >= index.min_train_size:
+            self.logger.info(
+                f"Index {index_file} is out of sync with the embeddings, rebuilding."
+            )
+            index.build(store.vectors)
+        if isinstance(index, QuantizedIndex):
+            self.logger.info(
+                f"{self.quantization} codes of {len(index)} rows: "
+                f"{index.nbytes / 2**20:.1f} MiB in memory, "
+                f"{len(store) * self.embedding_dim * 4 / 2**20:.1f} MiB of float32 rows on disk"
+            )
+        return index
+
+    def save_index(self) -> None:
+        if self._index.is_ready:
+            self._index.save(self.index_file)
 
     def _add(
         self,
-        normalized_embedding: np.ndarray,
-        chunk_info: dict[str, str],
+        embeddings: np.ndarray,
+        chunk_infos: list[dict[str, Union[str, int]]],
+        document_name: Optional[str] = None,
     ) -> None:
-        if np.linalg.norm(normalized_embedding) != 1:
-            normalized_embedding = normalized_embedding / np.linalg.norm(
-                normalized_embedding, axis=1, keepdims=True
-            )
-        uid = str(uuid.uuid4())
-        uid = int(uuid.UUID(uid)) >> 64
-        self._embeddings.append(normalized_embedding)
-        self._ids.append(uid)
-        self._chunks.append(chunk_info)
+        """
+        Add the rows of a document. The rows stored before for `document_name` (an older version of the document) are deleted.
+        """
+        # 63-bit ids so that they fit in the int64 id array of the store
+        uids = [uuid.uuid4().int >> 65 for _ in chunk_infos]
+        with self._write_lock, self._rwlock.write():
+            if document_name is not None:
+                ranges = self._doc_rows.get(document_name, [])
+                self._delete_rows([row for r in ranges for row in range(*r)])
+            if chunk_infos:
+                self._append_rows(embeddings, uids, chunk_infos)
+
+    def _delete_rows(self, rows: list[int]) -> None:
+        """
+        Tombstone `rows`: they stay in the store and the indices but are filtered out of the results. The caller holds the write lock.
+        """
+        rows = [row for row in rows if row not in self._deleted_rows]
+        if not rows:
+            return
+        self._deleted_rows.update(rows)
+        self._pending_deletes.extend(self._ids[row] for row in rows)
+        self._doc_rows = self._document_ranges(self._chunks, self._deleted_rows)
+        self.version += 1
+
+    def _append_rows(
+        self,
+        embeddings: np.ndarray,
+        uids: list[int],
+        chunk_infos: list[dict[str, Union[str, int]]],
+    ) -> None:
+        # The caller holds the write lock
+        self._store.add(embeddings, uids)
+        if self._index.is_ready:
+            self._index.add(embeddings)
+        elif len(self._store) >= self._index.min_train_size:
+            self._index.build(self._store.vectors)
+        self._ids.extend(uids)
+        self._chunks.extend(chunk_infos)
+        if self._bm25 is not None:
+            self._bm25.add([chunk_info["chunk"] for chunk_info in chunk_infos])
+        self._document_ranges(
+            self._chunks,
+            self._deleted_rows,
+            len(self._chunks) - len(chunk_infos),
+            self._doc_rows,
+        )
+        self.version += 1
+
+    @staticmethod
+    def _document_ranges(
+        chunks: list[dict],
+        deleted_rows: set[int],
+        start: int = 0,
+        doc_rows: Optional[dict[str, list[list[int]]]] = None,
+    ) -> dict[str, list[list[int]]]:
+        """
+        Document name -> `[start, end)` row ranges of `chunks`, the deleted rows excluded. The ranges of `doc_rows` are extended with the rows from `start` on. A document is vectorized in one go, so it usually spans a single range.
+        """
+        doc_rows = {} if doc_rows is None else doc_rows
+        for row in range(start, len(chunks)):
+            if row in deleted_rows:
+                continue
+            ranges = doc_rows.setdefault(chunks[row]["filename"], [])
+            if ranges and ranges[-1][1] == row:
+                ranges[-1][1] = row + 1
+            else:
+                ranges.append([row, row + 1])
+        return doc_rows
+
+    def document_rows(
+        self,
+        documents: Iterable[str],
+    ) -> Union[slice, np.ndarray]:
+        """
+        The rows of the chunks of `documents`, as a slice when they are contiguous.
+        """
+        ranges = sorted(
+            r for document in set(documents) for r in self._doc_rows.get(document, [])
+        )
+        if len(ranges) == 1:
+            return slice(*ranges[0])
+        return np.concatenate(
+            [np.arange(*r) for r in ranges] or [np.empty(0, dtype=np.int64)]
+        )
 
     def split_document(self, document_contents: str) -> list[str]:
-        start = 0
-        chunks = []
-        words = document_contents.split()
-        while start < len(words):
-            chunks.append(" ".join(words[start : start + self.num_chunks]))
-            start += self.num_chunks - self.overlap
-        return chunks
+        return [chunk.text for chunk in self._chunker.chunk(document_contents)]
+
+    def iter_split_document(self, pieces: Iterable[str]) -> Iterator[DocumentChunk]:
+        """
+        Split a document arriving in `pieces` (e.g. page ranges) into chunks of at most `num_chunks` tokens, see `MarkdownChunker`.
+
+        A chunk is yielded as soon as its blocks arrived. The chunks are the same as splitting the whole document at once.
+        """
+        return self._chunker.iter_chunks(pieces)
+
+    @staticmethod
+    def _chunk_infos(
+        chunks: list[DocumentChunk],
+        document_name: str,
+    ) -> list[dict[str, Union[str, int]]]:
+        return [
+            {
+                "filename": document_name,
+                "chunk": chunk.text,
+                "start": chunk.start,
+                "end": chunk.end,
+            }
+            for chunk in chunks
+        ]
+
+    def _make_batches(self, chunks: list[str]) -> list[tuple[int, list[str]]]:
+        """
+        Group `chunks` into `(start, batch)` requests bounded by `embed_batch_size` inputs and `embed_batch_tokens` estimated tokens.
+        """
+        batches = []
+        batch, start, num_tokens = [], 0, 0
+        for i, chunk in enumerate(chunks):
+            chunk_tokens = estimate_tokens(chunk)
+            if batch and (
+                len(batch) >= self.embed_batch_size
+                or num_tokens + chunk_tokens > self.embed_batch_tokens
+            ):
+                batches.append((start, batch))
+                batch, start, num_tokens = [], i, 0
+            batch.append(chunk)
+            num_tokens += chunk_tokens
+        if batch:
+            batches.append((start, batch))
+        return batches
+
+    def _embed_request(self, batch: list[str]) -> dict[str, Any]:
+        return {
+            "model": self.embedding_name,
+            "input": batch,
+            "dimensions": self.embedding_dim,
+            "encoding_format": "float",
+        }
+
+    def _retry_delay(self, attempt: int, error: Exception) -> Optional[float]:
+        """
+        The backoff before retrying an embedding request after its `attempt`-th failure, None once `embed_max_retries` are spent. The clients do not retry the embedding requests themselves, these retries are the only ones.
+        """
+        if attempt == self.embed_max_retries:
+            return None
+        delay = self.embed_backoff * (2**attempt) * (1 + random.random())
+        self.logger.warning(
+            f"Embedding request failed ({error.__class__.__name__}), "
+            f"retrying in {delay:.1f}s ({attempt + 1}/{self.embed_max_retries})"
+        )
+        return delay
+
+    def _embed_batch(self, batch: list[str]) -> list[list[float]]:
+        client = self.client.with_options(max_retries=0)
+        for attempt in range(self.embed_max_retries + 1):
+            try:
+                response = client.embeddings.create(**self._embed_request(batch))
+                return [
+                    d.embedding for d in sorted(response.data, key=lambda d: d.index)
+                ]
+            except _RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def _aembed_batch(
+        self,
+        client: AsyncOpenAI,
+        batch: list[str],
+    ) -> list[list[float]]:
+        client = client.with_options(max_retries=0)
+        for attempt in range(self.embed_max_retries + 1):
+            try:
+                response = await client.embeddings.create(**self._embed_request(batch))
+                return [
+                    d.embedding for d in sorted(response.data, key=lambda d: d.index)
+                ]
+            except _RETRYABLE_ERRORS as e:
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    def _lookup_embeddings(self, chunks: list[str]) -> tuple[np.ndarray, list[int]]:
+        """
+        The embeddings of `chunks` found in the embedding cache, and the positions of the chunks still to embed.
+        """
+        embeddings = np.empty((len(chunks), self.embedding_dim), dtype=np.float32)
+        if self.cache is None:
+            return embeddings, list(range(len(chunks)))
+        cached = self.cache.get_many(self.embedding_name, self.embedding_dim, chunks)
+        missing = []
+        for i, vector in enumerate(cached):
+            if vector is None:
+                missing.append(i)
+            else:
+                embeddings[i] = vector
+        return embeddings, missing
+
+    def _complete_embeddings(
+        self,
+        embeddings: np.ndarray,
+        missing: list[int],
+        texts: list[str],
+        fetched: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Fill in and cache the `fetched` embeddings of the `missing` chunks `texts`, then normalize.
+        """
+        if missing:
+            embeddings[missing] = fetched
+            if self.cache is not None:
+                self.cache.put_many(
+                    self.embedding_name, self.embedding_dim, texts, fetched
+                )
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return np.divide(embeddings, norms, out=embeddings, where=norms > 0)
 
     def embed(self, chunks: Union[list[str], str]) -> np.ndarray:
+        """
+        Embed `chunks` into normalized float32 vectors of shape `(len(chunks), embed_dim)`.
+
+        Chunks found in the embedding cache are not sent. The rest is sent in batches, up to `embed_concurrency` requests in flight. Rate limits and transient errors are retried with exponential backoff, a request that still fails raises instead of producing zero vectors.
+        """
         if isinstance(chunks, str):
             chunks = [chunks]
-        embeddings = []
-        for chunk in chunks:
-            try:
-                response = self.embedding_model.embeddings.create(
-                    model=self.embedding_name,
-                    input=chunk,
-                    dimensions=self.embedding_dim,
-                    encoding_format="float",
-                ).model_dump()
-                embeds = response["data"][0]["embedding"]
-            except Exception as e:
-                embeds = [0.0] * self.embedding_dim
-            finally:
-                embeddings.append(embeds)
-        embeddings = np.linalg.norm(embeddings, axis=1, keepdims=True)
-        return np.array(embeddings, dtype=np.float32)
-
-    def search(self, query: str) -> list[tuple[float, dict[str, str]]]:
-        if len(self._embeddings) == 0:
-            return []
-        query_embed = self.embed(query)
-        embeds = np.stack(self._embeddings, axis=0)
-        scores = np.dot(embeds, query_embed)
-        topk_indices = np.argsort(scores)[-self.topk :][::-1]
-        topk_uid = self._ids[topk_indices]
-        results = [(scores[i], self._chunks[topk_uid[i]]) for i in topk_indices]
-        return results
+        embeddings, missing = self._lookup_embeddings(chunks)
+
+        texts = [chunks[i] for i in missing]
+        fetched = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        if missing:
+            batches = self._make_batches(texts)
+            if len(batches) <= 1 or self.embed_concurrency <= 1:
+                results = map(self._embed_batch, (batch for _, batch in batches))
+                for (start, batch), vectors in zip(batches, results):
+                    fetched[start : start + len(batch)] = vectors
+            else:
+                with ThreadPoolExecutor(
+                    max_workers=min(self.embed_concurrency, len(batches))
+                ) as pool:
+                    results = pool.map(
+                        self._embed_batch, (batch for _, batch in batches)
+                    )
+                    for (start, batch), vectors in zip(batches, results):
+                        fetched[start : start + len(batch)] = vectors
+        return self._complete_embeddings(embeddings, missing, texts, fetched)
+
+    async def aembed(self, chunks: Union[list[str], str]) -> np.ndarray:
+        """
+        `embed` without blocking the event loop: the batches are sent on the asynchronous client shared in the loop (see `src.llm_client`), up to `embed_concurrency` at a time.
+        """
+        if isinstance(chunks, str):
+            chunks = [chunks]
+        embeddings, missing = self._lookup_embeddings(chunks)
+
+        texts = [chunks[i] for i in missing]
+        fetched = np.empty((len(texts), self.embedding_dim), dtype=np.float32)
+        if missing:
+            client = get_async_client(
+                self.client.api_key, self.client.base_url, self.client_cfgs
+            )
+            semaphore = asyncio.Semaphore(max(self.embed_concurrency, 1))
+
+            async def _send(start: int, batch: list[str]) -> None:
+                async with semaphore:
+                    vectors = await self._aembed_batch(client, batch)
+                fetched[start : start + len(batch)] = vectors
+
+            await asyncio.gather(
+                *(_send(start, batch) for start, batch in self._make_batches(texts))
+            )
+        return self._complete_embeddings(embeddings, missing, texts, fetched)
+
+    def search(
+        self,
+        query: str,
+        documents: Optional[Iterable[str]] = None,
+    ) -> list[tuple[float, dict[str, str]]]:
+        return self.search_batch([query], documents=documents)[0]
+
+    async def asearch(
+        self,
+        query: str,
+        documents: Optional[Iterable[str]] = None,
+    ) -> list[tuple[float, dict[str, str]]]:
+        return (await self.asearch_batch([query], documents=documents))[0]
+
+    async def asearch_batch(
+        self,
+        queries: list[str],
+        topk: Optional[int] = None,
+        documents: Optional[Iterable[str]] = None,
+    ) -> list[list[tuple[float, dict[str, str]]]]:
+        """
+        `search_batch` for the event loop: the queries are embedded with `aembed`, the search itself runs in a worker thread.
+        """
+        query_embeds = None
+        if queries and self.retrieval != "lexical":
+            embeds = [
+                None if self.query_cache is None else self.query_cache.get_embedding(q)
+                for q in queries
+            ]
+            missing = [i for i, embed in enumerate(embeds) if embed is None]
+            if missing:
+                fetched = await self.aembed([queries[i] for i in missing])
+                for i, embed in zip(missing, fetched):
+                    embeds[i] = embed
+                    if self.query_cache is not None:
+                        self.query_cache.put_embedding(queries[i], embed)
+            query_embeds = np.stack(embeds)
+        return await asyncio.to_thread(
+            self.search_batch, queries, topk, documents, query_embeds
+        )
+
+    def search_batch(
+        self,
+        queries: list[str],
+        topk: Optional[int] = None,
+        documents: Optional[Iterable[str]] = None,
+        query_embeds: Optional[np.ndarray] = None,
+    ) -> list[list[tuple[float, dict[str, str]]]]:
+        """
+        Search several queries at once, following `cfgs.retrieval`:
+
+        - `dense`: the queries are embedded together and scored against the store in one matrix-matrix product.
+        - `lexical`: BM25 only, no embedding request is made.
+        - `hybrid`: the dense and BM25 rankings are fused by reciprocal rank, the scores are the fused ones.
+
+        If `documents` (document names, the `filename` of the chunks) are given, only their rows are scored, exactly, whatever the index backend. `query_embeds` are the embeddings of the queries if already known (see `asearch_batch`), otherwise the queries are embedded before the store is locked for the search, so the embedding requests never hold back a reload.
+
+        Returns the `topk` (defaults to `cfgs.topk`) `(score, chunk_info)` of each query, best first.
+        """
+        if query_embeds is None and queries and self.retrieval != "lexical":
+            query_embeds = self.embed_queries(queries)
+        with self._rwlock.read():
+            rows = None if documents is None else self.document_rows(documents)
+            if (
+                len(self._chunks) == 0
+                or not queries
+                or (isinstance(rows, np.ndarray) and len(rows) == 0)
+            ):
+                return [[] for _ in queries]
+
+            topk = topk or self.topk
+            # The document rows exclude the deleted ones, a search over all the rows
+            # fetches more and searches deeper while the deleted ones leave a query short
+            num_rows = topk if rows is not None or not self._deleted_rows else 2 * topk
+            while True:
+                if self.query_cache is None:
+                    hits = self._search_rows(queries, num_rows, rows, query_embeds)
+                else:
+                    hits = self._cached_search_rows(
+                        queries, num_rows, rows, documents, query_embeds
+                    )
+
+                # Rows without metadata (e.g. a crash between saving rows and meta) are skipped
+                results = [
+                    [
+                        (float(score), self._chunks[row])
+                        for score, row in zip(query_scores, query_rows)
+                        if 0 <= row < len(self._chunks)
+                        and row not in self._deleted_rows
+                    ][:topk]
+                    for query_scores, query_rows in hits
+                ]
+                if num_rows >= len(self._chunks) or all(
+                    len(result) == topk
+                    or (np.asarray(query_rows) >= 0).sum() < num_rows
+                    for result, (_, query_rows) in zip(results, hits)
+                ):
+                    return results
+                num_rows = min(num_rows * 4, len(self._chunks))
+
+    def _search_rows(
+        self,
+        queries: list[str],
+        topk: int,
+        rows: Optional[Union[slice, np.ndarray]] = None,
+        query_embeds: Optional[np.ndarray] = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        The `(scores, rows)` of the `topk` best rows of each query, `query_embeds` are the embeddings of the queries (None for a lexical search).
+        """
+        if self.retrieval == "lexical":
+            return [self._bm25.search(query, topk, rows) for query in queries]
+        if self.retrieval == "hybrid":
+            # Fuse deeper rankings than `topk`, a chunk ranked low by one retriever may still win
+            num_candidates = max(topk * 4, 50)
+            _, dense_rows = self._dense_search(query_embeds, num_candidates, rows)
+            return [
+                reciprocal_rank_fusion(
+                    [query_rows, self._bm25.search(query, num_candidates, rows)[1]],
+                    topk,
+                    self.rrf_k,
+                )
+                for query, query_rows in zip(queries, dense_rows)
+            ]
+        return list(zip(*self._dense_search(query_embeds, topk, rows)))
+
+    def _cached_search_rows(
+        self,
+        queries: list[str],
+        topk: int,
+        rows: Optional[Union[slice, np.ndarray]],
+        documents: Optional[Iterable[str]],
+        query_embeds: Optional[np.ndarray] = None,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        `_search_rows` through the query cache: a query searched before at the current store version (or, for a dense search, one close enough in meaning) is answered from the cache, only the others are embedded and searched.
+        """
+        params = f"{self.retrieval}:{topk}"
+        if documents is not None:
+            params += ":" + ",".join(sorted(set(documents)))
+        hits = [
+            self.query_cache.get_results(query, params, self.version)
+            for query in queries
+        ]
+        missing = [i for i, hit in enumerate(hits) if hit is None]
+
+        if self.retrieval == "lexical":
+            query_embeds = None
+        elif missing:
+            query_embeds = query_embeds[missing]
+            # The BM25 half of a hybrid ranking depends on the exact words, only reuse dense results
+            if self.retrieval == "dense":
+                for i, embed in zip(missing, query_embeds):
+                    hits[i] = self.query_cache.find_similar(embed, params, self.version)
+                keep = [j for j, i in enumerate(missing) if hits[i] is None]
+                missing, query_embeds = [missing[j] for j in keep], query_embeds[keep]
+
+        if missing:
+            searched = self._search_rows(
+                [queries[i] for i in missing], topk, rows, query_embeds
+            )
+            for i, hit in zip(missing, searched):
+                hits[i] = hit
+                self.query_cache.put_results(queries[i], params, self.version, *hit)
+        return hits
+
+    def embed_queries(self, queries: list[str]) -> np.ndarray:
+        """
+        `embed` the queries, through the query cache if any: a query searched or embedded before is not sent again.
+        """
+        if self.query_cache is None:
+            return self.embed(queries)
+        embeds = [self.query_cache.get_embedding(query) for query in queries]
+        missing = [i for i, embed in enumerate(embeds) if embed is None]
+        if missing:
+            fetched = self.embed([queries[i] for i in missing])
+            for i, embed in zip(missing, fetched):
+                embeds[i] = embed
+                self.query_cache.put_embedding(queries[i], embed)
+        return np.stack(embeds)
+
+    def _dense_search(
+        self,
+        query_embeds: np.ndarray,
+        topk: int,
+        rows: Optional[Union[slice, np.ndarray]] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        if rows is not None:
+            return FlatIndex(self._store).search(query_embeds, topk, rows)
+        # An untrained approximate index falls back to the exact search
+        index = self._index if self._index.is_ready else FlatIndex(self._store)
+        return index.search(query_embeds, topk)
 
     def _vectorization(
         self,
@@ -135,11 +1091,58 @@ class PaperRAG:
             return
         with open(path, "r") as f:
             contents = f.read()
-        chunks = self.split_document(contents)
-        chunk_infos = [{"filename": document_name, "chunk": chunk} for chunk in chunks]
-        embeds = self.embed(chunks)
-        for embed, chunk_info in zip(embeds, chunk_infos):
-            self._add(embed, chunk_info)
+        chunks = self._chunker.chunk(contents)
+        embeds = self.embed([chunk.text for chunk in chunks])
+        self._add(embeds, self._chunk_infos(chunks, document_name), document_name)
+        if self.cache is not None:
+            self.logger.info(f"Embedding cache {self.cache.stats}")
+
+    def vectorize_stream(
+        self,
+        pieces: Iterable[str],
+        document_name: str,
+    ) -> None:
+        """
+        Chunk and embed a document while its `pieces` are still being produced (see `PDFExtractor.stream_pdf_to_markdown`), then persist the store.
+
+        Chunks are embedded in the background in batches, at most `_MAX_IN_FLIGHT` batches wait for their embeddings so the requests stay bounded. The rows are only added once the whole document is embedded: a stream failing midway leaves nothing in the store.
+        """
+        batch_size = self.embed_batch_size * max(self.embed_concurrency, 1)
+        in_flight: deque[tuple[list[DocumentChunk], Future]] = deque()
+        embeds, chunk_infos = [], []
+
+        def _drain(limit: int) -> None:
+            while len(in_flight) > limit:
+                chunks, future = in_flight.popleft()
+                embeds.append(future.result())
+                chunk_infos.extend(self._chunk_infos(chunks, document_name))
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            chunks = []
+            for chunk in self.iter_split_document(pieces):
+                chunks.append(chunk)
+                if len(chunks) >= batch_size:
+                    texts = [chunk.text for chunk in chunks]
+                    in_flight.append((chunks, pool.submit(self.embed, texts)))
+                    chunks = []
+                    _drain(self._MAX_IN_FLIGHT)
+            if chunks:
+                texts = [chunk.text for chunk in chunks]
+                in_flight.append((chunks, pool.submit(self.embed, texts)))
+            _drain(0)
+
+        self._add(
+            np.concatenate(embeds) if embeds else None, chunk_infos, document_name
+        )
+        self._persist()
+
+    def vectorize_markdowns(self, pdf_markdown_maps: dict[str, Path]) -> None:
+        """
+        Embed the markdown files `{document_name: markdown_path}` and persist the store.
+        """
+        for document_name, markdown_path in pdf_markdown_maps.items():
+            self._vectorization(markdown_path, document_name)
+        self._persist()
 
     def vectorization_runtime(
         self,
@@ -154,4 +1157,4 @@ class PaperRAG:
         document_name: str,
     ) -> None:
         self._vectorization(path, document_name)
-        self._save_meta()
+        self._persist()
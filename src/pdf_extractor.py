@@ -1,9 +1,10 @@
+import os
 import re
+import threading
+import multiprocessing as mp
 
-from marker.config.parser import ConfigParser
-from marker.converters.pdf import PdfConverter
-from marker.output import text_from_rendered
-from marker.models import create_model_dict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Iterator, Optional
 from PIL import Image
 from pathlib import Path
 
@@ -11,6 +12,27 @@ from src.singleton import singleton
 from src.logger import get_logger, beautified_tqdm
 from src.cfg_mappings import ExtractorConfigs
 from src.types.agent_info import ExtractorOutput
+from src.extraction_worker import ExtractionClient
+from src.image_writer import ImageWriter
+
+# marker (and torch through it) and pypdfium2 are imported by the first conversion, not with `src`
+if TYPE_CHECKING:
+    from marker.converters.pdf import PdfConverter
+
+# The extractor of a worker process, created once by `_init_worker`
+_worker_extractor: Optional["PDFExtractor"] = None
+
+
+def _init_worker(extractor_cfgs: ExtractorConfigs) -> None:
+    global _worker_extractor
+    _worker_extractor = PDFExtractor(extractor_cfgs)
+
+
+def _convert_in_worker(pdf_path: Path) -> ExtractorOutput:
+    output = _worker_extractor.convert_pdf_to_markdown(pdf_path)
+    # Worker processes exit without running `atexit`, write the images now
+    _worker_extractor.image_writer.flush()
+    return output
 
 
 @singleton
@@ -24,21 +46,60 @@ class PDFExtractor:
         self.output_dir = Path(self.cfg.output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
+        # The marker models are only loaded by the first conversion
+        self._artifact_dict: Optional[dict] = None
+        self._pdf_converter: Optional["PdfConverter"] = None
+        self._converter_lock = threading.Lock()
+
+        self.image_writer = ImageWriter(
+            self.logger,
+            num_workers=self.cfg.image_writers,
+            max_pending=self.cfg.max_pending_images,
+            image_format=self.cfg.image_format,
+            compress_level=self.cfg.image_compress_level,
+            quality=self.cfg.image_quality,
+        )
+
+        self.worker = (
+            ExtractionClient(self.cfg.worker_address)
+            if self.cfg.worker_address
+            else None
+        )
+
+    def _create_converter(self, extra_configs: Optional[dict] = None) -> "PdfConverter":
+        """
+        A converter sharing the loaded models, `extra_configs` (e.g. a `page_range`) are passed to marker.
+        """
+        from marker.config.parser import ConfigParser
+        from marker.converters.pdf import PdfConverter
+        from marker.models import create_model_dict
+
+        if self._artifact_dict is None:
+            self.logger.info("Loading `marker` models")
+            self._artifact_dict = create_model_dict()
         configs = {
             "output_format": "markdown",
             "output_dir": self.output_dir,
             "use_llm": False,
             "workers": 0,
+            **(extra_configs or {}),
         }
         config_parser = ConfigParser(configs)
-        self.pdf_converter = PdfConverter(
+        return PdfConverter(
             config=config_parser.generate_config_dict(),
-            artifact_dict=create_model_dict(),
+            artifact_dict=self._artifact_dict,
             processor_list=config_parser.get_processors(),
             renderer=config_parser.get_renderer(),
             llm_service=config_parser.get_llm_service(),
         )
 
+    @property
+    def pdf_converter(self) -> "PdfConverter":
+        with self._converter_lock:
+            if self._pdf_converter is None:
+                self._pdf_converter = self._create_converter()
+        return self._pdf_converter
+
     def extract_pdf_title(
         self,
         markdown_text: str,
@@ -58,17 +119,36 @@ class PDFExtractor:
         self,
         image: Image.Image,
         path_to_save: Path,
-    ) -> None:
-        try:
-            image.save(path_to_save)
-        except Exception as e:
-            self.logger.warning(f"Failed to save image {path_to_save}: {e}")
+    ) -> Path:
+        """
+        Queue the image to be written in the background, returns the path it will be written to. Call `self.image_writer.flush()` to wait for the writes.
+        """
+        return self.image_writer.submit(image, path_to_save)
+
+    def _save_all_images(
+        self,
+        images: dict[str, Image.Image],
+        save_dir: Path,
+        markdown_text: str,
+    ) -> tuple[str, list[str]]:
+        """
+        Queue all the `images` and point the markdown to their final names (the suffix changes with `image_format`).
+        """
+        names = []
+        for name, image in images.items():
+            saved_name = self.save_images(image, save_dir / name).name
+            if saved_name != name:
+                markdown_text = markdown_text.replace(f"]({name})", f"]({saved_name})")
+            names.append(saved_name)
+        return markdown_text, names
 
     def convert_pdf_to_markdown(
         self,
         pdf_path: Path,
     ) -> ExtractorOutput:
 
+        from marker.output import text_from_rendered
+
         self.logger.info(f"Using `marker` to convert PDF: {pdf_path}")
         with beautified_tqdm():
             rendered = self.pdf_converter(str(pdf_path))
@@ -84,8 +164,10 @@ class PDFExtractor:
         save_dir = self.output_dir / normalized_title
         save_dir.mkdir(parents=True, exist_ok=True)
 
-        for path_to_save, image in images.items():
-            self.save_images(image, save_dir / path_to_save)
+        # The images are written in the background, the markdown does not wait for them
+        markdown_text, image_names = self._save_all_images(
+            images, save_dir, markdown_text
+        )
 
         with open(save_dir / f"{normalized_title}.md", "w") as md:
             md.write(markdown_text)
@@ -99,8 +181,149 @@ class PDFExtractor:
             normalized_title=normalized_title,
             save_dir=save_dir,
             markdown_name=f"{normalized_title}.md",
-            num_images=len(images),
-            images=images.keys(),
+            num_images=len(image_names),
+            images=image_names,
         )
 
         return outputs
+
+    def render_page_ranges(
+        self,
+        pdf_path: Path,
+        pages_per_step: int,
+    ) -> Iterator[tuple[str, dict[str, Image.Image]]]:
+        """
+        Render the PDF `pages_per_step` pages at a time, yielding the markdown and the images of each page range.
+        """
+        import pypdfium2 as pdfium
+        from marker.output import text_from_rendered
+
+        pdf = pdfium.PdfDocument(str(pdf_path))
+        num_pages = len(pdf)
+        pdf.close()
+        for start in range(0, num_pages, pages_per_step):
+            page_range = list(range(start, min(start + pages_per_step, num_pages)))
+            with self._converter_lock:
+                converter = self._create_converter({"page_range": page_range})
+            self.logger.info(
+                f"Using `marker` to convert pages {page_range[0]}-{page_range[-1]} "
+                f"of {num_pages} of PDF: {pdf_path}"
+            )
+            with beautified_tqdm():
+                rendered = converter(str(pdf_path))
+                markdown_text, _, images = text_from_rendered(rendered)
+            yield markdown_text, images
+
+    def stream_pdf_to_markdown(self, pdf_path: Path) -> "MarkdownStream":
+        return MarkdownStream(self, pdf_path, self.cfg.pages_per_step)
+
+    def convert_pdfs_to_markdown(
+        self,
+        pdf_paths: list[Path],
+    ) -> Iterator[ExtractorOutput]:
+        """
+        Convert several PDFs, up to `num_pdf_concurrent` at a time, yielding the outputs as they finish (not in the input order).
+
+        Each worker process loads the marker models once and converts many files. A file that fails to convert is logged and skipped, it does not stop the others.
+
+        If a resident extraction worker (see `src.extraction_worker`) is listening on `worker_address`, the files are sent to it instead, no models are loaded in this process.
+        """
+        if self.worker is not None and self.worker.is_available():
+            self.logger.info(f"Converting with the worker at {self.cfg.worker_address}")
+            for pdf_path in pdf_paths:
+                try:
+                    yield self.worker.convert_pdf_to_markdown(pdf_path)
+                except Exception as e:
+                    self.logger.warning(f"Failed to convert PDF {pdf_path}: {e}")
+            return
+
+        num_workers = min(self.cfg.num_pdf_concurrent, len(pdf_paths))
+        if num_workers <= 1:
+            for pdf_path in pdf_paths:
+                try:
+                    yield self.convert_pdf_to_markdown(pdf_path)
+                except Exception as e:
+                    self.logger.warning(f"Failed to convert PDF {pdf_path}: {e}")
+            return
+
+        self.logger.info(f"Converting {len(pdf_paths)} PDFs with {num_workers} workers")
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            # `spawn` since forking a process holding torch/CUDA state is unsafe
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.cfg,),
+        ) as pool:
+            futures = {
+                pool.submit(_convert_in_worker, pdf_path): pdf_path
+                for pdf_path in pdf_paths
+            }
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    self.logger.warning(f"Failed to convert PDF {futures[future]}: {e}")
+
+
+class MarkdownStream:
+    """
+    The markdown of a PDF, page range by page range, so that it can be chunked and embedded while the next pages are rendered.
+
+    Iterating renders the pages and yields their markdown. The markdown and images are staged in the output directory and moved to the paper directory once the last page is rendered, `output` is then set. The pieces joined with blank lines are the markdown file written to disk.
+    """
+
+    def __init__(
+        self,
+        extractor: PDFExtractor,
+        pdf_path: Path,
+        pages_per_step: int,
+    ) -> None:
+        self.extractor = extractor
+        self.pdf_path = Path(pdf_path)
+        self.pages_per_step = pages_per_step
+        self.output: Optional[ExtractorOutput] = None
+
+    def __iter__(self) -> Iterator[str]:
+        extractor = self.extractor
+        stage_dir = extractor.output_dir / f".partial-{self.pdf_path.stem}"
+        stage_dir.mkdir(parents=True, exist_ok=True)
+        stage_markdown = stage_dir / "markdown.md"
+
+        title = None
+        image_names = []
+        with open(stage_markdown, "w") as md:
+            for i, (markdown_text, images) in enumerate(
+                extractor.render_page_ranges(self.pdf_path, self.pages_per_step)
+            ):
+                if title is None:
+                    titles = re.findall(r"^# (.+)$", markdown_text, re.MULTILINE)
+                    title = titles[0] if titles else None
+                markdown_text, names = extractor._save_all_images(
+                    images, stage_dir, markdown_text
+                )
+                image_names.extend(names)
+                md.write(("\n\n" if i else "") + markdown_text)
+                yield markdown_text
+
+        title = title or self.pdf_path.stem
+        normalized_title = extractor.normalize_title(title)[:50]
+        save_dir = extractor.output_dir / normalized_title
+        save_dir.mkdir(parents=True, exist_ok=True)
+        # The staged images have to be on disk before they are moved
+        extractor.image_writer.flush()
+        os.replace(stage_markdown, save_dir / f"{normalized_title}.md")
+        for staged in stage_dir.iterdir():
+            os.replace(staged, save_dir / staged.name)
+        stage_dir.rmdir()
+        extractor.logger.info(f"Markdown files and images saved to {save_dir}")
+
+        self.output = ExtractorOutput(
+            pdf_path=self.pdf_path,
+            pdf_name=self.pdf_path.name,
+            paper_title=title,
+            normalized_title=normalized_title,
+            save_dir=save_dir,
+            markdown_name=f"{normalized_title}.md",
+            num_images=len(image_names),
+            images=image_names,
+        )
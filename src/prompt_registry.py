@@ -0,0 +1,126 @@
+import re
+import time
+import threading
+
+from pathlib import Path
+from typing import Union
+
+# `{{ name }}` placeholders, `$` and single braces are common in markdown prompts (math, code)
+_PLACEHOLDER_RE = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+
+class PromptTemplate:
+    """
+    A prompt split once at its `{{ name }}` placeholders, rendering only joins the pieces. A placeholder without a value is kept as is.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        # Literals at even positions, variable names at odd ones
+        self._pieces = _PLACEHOLDER_RE.split(text)
+        self._raw = {m.group(1): m.group(0) for m in _PLACEHOLDER_RE.finditer(text)}
+
+    @property
+    def variables(self) -> set[str]:
+        return set(self._raw)
+
+    def render(self, **variables: str) -> str:
+        if not self._raw:
+            return self.text
+        return "".join(
+            piece if i % 2 == 0 else str(variables.get(piece, self._raw[piece]))
+            for i, piece in enumerate(self._pieces)
+        )
+
+
+class PromptRegistry:
+    """
+    The markdown prompts of `prompt_dir`, read once and kept in memory with their rendered variants.
+
+    The directory is checked at most every `reload_interval` seconds (a negative one never checks again): only the prompts whose mtime changed are read again and only their rendered variants dropped, added and removed prompts are picked up too. Between two checks a prompt costs no filesystem access.
+    """
+
+    def __init__(
+        self, prompt_dir: Union[str, Path], reload_interval: float = 1.0
+    ) -> None:
+        self.prompt_dir = Path(prompt_dir)
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._templates: dict[str, tuple[int, PromptTemplate]] = {}
+        self._rendered: dict[tuple, str] = {}
+        self._checked = float("-inf")
+        self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> None:
+        """
+        Reload the prompts changed on disk, if the last check is older than `reload_interval`.
+        """
+        now = time.monotonic()
+        if not force and (
+            self.reload_interval < 0 or now - self._checked < self.reload_interval
+        ):
+            return
+        with self._lock:
+            self._checked = now
+            mtimes = (
+                {p.stem: p.stat().st_mtime_ns for p in self.prompt_dir.glob("*.md")}
+                if self.prompt_dir.is_dir()
+                else {}
+            )
+            changed = {
+                name
+                for name in mtimes.keys() | self._templates.keys()
+                if name not in self._templates
+                or mtimes.get(name) != self._templates[name][0]
+            }
+            if not changed:
+                return
+            for name in changed:
+                if name in mtimes:
+                    text = (self.prompt_dir / f"{name}.md").read_text()
+                    self._templates[name] = (mtimes[name], PromptTemplate(text))
+                else:
+                    del self._templates[name]
+            # The joined prompts depend on all of them
+            self._rendered = {
+                key: value
+                for key, value in self._rendered.items()
+                if key[0] is not None and key[0] not in changed
+            }
+
+    def names(self) -> list[str]:
+        self.refresh()
+        return sorted(self._templates)
+
+    def get(self, name: str, /, **variables: str) -> str:
+        """
+        The prompt `<prompt_dir>/<name>.md` with its placeholders substituted by `variables`.
+        """
+        self.refresh()
+        key = (name, tuple(sorted(variables.items())))
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            with self._lock:
+                if name not in self._templates:
+                    raise FileNotFoundError(
+                        f"Prompt {name} not found in {self.prompt_dir}"
+                    )
+                rendered = self._templates[name][1].render(**variables)
+                self._rendered[key] = rendered
+        return rendered
+
+    def join(self, separator: str = "\n", /, **variables: str) -> str:
+        """
+        All the prompts, rendered and joined in the order of their names, each followed by `separator`.
+        """
+        self.refresh()
+        key = (None, separator, tuple(sorted(variables.items())))
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            with self._lock:
+                rendered = "".join(
+                    self._templates[name][1].render(**variables) + separator
+                    for name in sorted(self._templates)
+                )
+                self._rendered[key] = rendered
+        return rendered
@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+
+from typing import Any, Optional, Union
+from pathlib import Path
+from collections import OrderedDict
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+class QueryCache:
+    """
+    An in-memory LRU of the search queries: normalized query text -> its embedding and its top-k results (scores and rows), so a repeated question is answered without an embedding request nor a search.
+
+    Results are tagged with the store `version` they were computed at and ignored once the store changed. A query whose text is not cached, but whose embedding has a cosine similarity of at least `similarity` with a cached one, reuses the results of that one (a semantic hit), a `similarity` above 1 (the default) disables it.
+
+    `save` and `load` persist the entries, the results are only kept if the store `signature` did not change in between.
+    """
+
+    def __init__(self, max_entries: int = 1024, similarity: float = 1.01) -> None:
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # text -> {"embedding": array or None, "results": {params: (version, scores, rows)}}
+        self._entries: OrderedDict[str, dict[str, Any]] = OrderedDict()
+        # Stacked embeddings of the entries for the semantic lookup, rebuilt when they change
+        self._matrix: Optional[tuple[list[str], np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return _SPACES_RE.sub(" ", text).strip().lower()
+
+    @property
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.semantic_hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.semantic_hits) / total if total else 0.0,
+        }
+
+    def _entry(self, text: str) -> dict[str, Any]:
+        key = self.normalize(text)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {"embedding": None, "results": {}}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._matrix = None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get_embedding(self, text: str) -> Optional[np.ndarray]:
+        with self._lock:
+            entry = self._entries.get(self.normalize(text))
+            return None if entry is None else entry["embedding"]
+
+    def put_embedding(self, text: str, embedding: np.ndarray) -> None:
+        with self._lock:
+            self._entry(text)["embedding"] = np.asarray(embedding, dtype=np.float32)
+            self._matrix = None
+
+    def get_results(
+        self,
+        text: str,
+        params: str,
+        version: int,
+    ) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """
+        The cached `(scores, rows)` of the query `text` searched with `params`, None if missing or computed at another store version.
+        """
+        with self._lock:
+            entry = self._entries.get(self.normalize(text))
+            result = None if entry is None else entry["results"].get(params)
+            if result is None or result[0] != version:
+                return None
+            self._entries.move_to_end(self.normalize(text))
+            self.hits += 1
+            return result[1], result[2]
+
+    def find_similar(
+        self,
+        embedding: np.ndarray,
+        params: str,
+        version: int,
+    ) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """
+        The cached `(scores, rows)` of the most similar query searched with `params` at `version`, if it is similar enough.
+        """
+        with self._lock:
+            if self.similarity <= 1:
+                if self._matrix is None:
+                    keys = [
+                        k
+                        for k, e in self._entries.items()
+                        if e["embedding"] is not None
+                    ]
+                    embeddings = [self._entries[k]["embedding"] for k in keys]
+                    self._matrix = keys, np.stack(embeddings) if keys else None
+                keys, matrix = self._matrix
+                if keys:
+                    similarities = matrix @ np.asarray(embedding, dtype=np.float32)
+                    for i in np.argsort(-similarities):
+                        if similarities[i] < self.similarity:
+                            break
+                        result = self._entries[keys[i]]["results"].get(params)
+                        if result is not None and result[0] == version:
+                            self.semantic_hits += 1
+                            return result[1], result[2]
+            return None
+
+    def put_results(
+        self,
+        text: str,
+        params: str,
+        version: int,
+        scores: np.ndarray,
+        rows: np.ndarray,
+    ) -> None:
+        with self._lock:
+            self.misses += 1
+            results = self._entry(text)["results"]
+            # Results of older store versions are never valid again
+            for key in [k for k, r in results.items() if r[0] != version]:
+                del results[key]
+            results[params] = (
+                version,
+                np.asarray(scores, dtype=np.float32),
+                np.asarray(rows, dtype=np.int64),
+            )
+
+    def save(self, path: Union[str, Path], signature: str, version: int) -> None:
+        """
+        Write the entries to `path`, with the results computed at `version` of the store identified by `signature`.
+        """
+        path = Path(path)
+        with self._lock:
+            texts = list(self._entries)
+            if not texts:
+                return
+            dims = {
+                len(e["embedding"])
+                for e in self._entries.values()
+                if e["embedding"] is not None
+            }
+            dim = dims.pop() if dims else 0
+            embeddings = np.zeros((len(texts), dim), dtype=np.float32)
+            has_embedding = np.zeros(len(texts), dtype=bool)
+            results = []
+            for i, text in enumerate(texts):
+                entry = self._entries[text]
+                if entry["embedding"] is not None:
+                    embeddings[i], has_embedding[i] = entry["embedding"], True
+                results.append(
+                    {
+                        params: [scores.tolist(), rows.tolist()]
+                        for params, (v, scores, rows) in entry["results"].items()
+                        if v == version
+                    }
+                )
+
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        # A file object, `np.savez` would append `.npz` to the path
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                texts=np.array(texts, dtype=str),
+                embeddings=embeddings,
+                has_embedding=has_embedding,
+                results=np.array(json.dumps(results)),
+                signature=np.array(signature),
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, path: Union[str, Path], signature: str, version: int) -> None:
+        """
+        Read the entries saved in `path`, their results are tagged with `version` if the store `signature` is unchanged and dropped otherwise.
+        """
+        path = Path(path)
+        if not path.exists():
+            return
+        with np.load(path) as data:
+            texts = [str(text) for text in data["texts"]]
+            embeddings, has_embedding = data["embeddings"], data["has_embedding"]
+            results = json.loads(str(data["results"]))
+            same_store = str(data["signature"]) == signature
+
+        with self._lock:
+            # The most recently used entries are last
+            for i in range(max(len(texts) - self.max_entries, 0), len(texts)):
+                entry = self._entry(texts[i])
+                if has_embedding[i]:
+                    entry["embedding"] = embeddings[i]
+                if same_store:
+                    entry["results"] = {
+                        params: (
+                            version,
+                            np.array(scores, dtype=np.float32),
+                            np.array(rows, dtype=np.int64),
+                        )
+                        for params, (scores, rows) in results[i].items()
+                    }
+            self._matrix = None
@@ -16,6 +16,15 @@ class ExtractorOutput:
     images: list[str]
 
 
+@dataclass
+class DocumentChunk:
+
+    text: str
+    # Character offsets of the chunk in the source markdown, `[start, end)`
+    start: int
+    end: int
+
+
 @dataclass
 class AgentInputs:
 
@@ -42,6 +51,6 @@ class Conversation:
     content: str
     file_refs: set[str]
 
-    # TODO: summary converstions embed contents
+    # Set on the round summaries of `HistoryCompressor`
     summary: Optional[str] = None
     embeddings: Optional[list[float]] = None
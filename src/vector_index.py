@@ -0,0 +1,453 @@
+import os
+import struct
+import numpy as np
+
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Optional, Union
+from pathlib import Path
+
+from src.embedding_store import EmbeddingStore, MmapEmbeddingStore
+
+# faiss is imported by the approximate and quantized indices only, the exact search does without it
+if TYPE_CHECKING:
+    import faiss
+
+
+def topk_rows(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The `k` best scores and their positions along the last axis, best first.
+
+    `argpartition` selects the candidates in O(N), only those `k` are sorted.
+    """
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k < n:
+        rows = np.argpartition(scores, n - k, axis=-1)[..., n - k :]
+    else:
+        rows = np.broadcast_to(np.arange(n), scores.shape).copy()
+    top = np.take_along_axis(scores, rows, axis=-1)
+    order = np.argsort(-top, axis=-1)
+    return (
+        np.take_along_axis(top, order, axis=-1),
+        np.take_along_axis(rows, order, axis=-1),
+    )
+
+
+def positions_to_rows(
+    positions: np.ndarray,
+    rows: Optional[Union[slice, np.ndarray]],
+    num_rows: int,
+) -> np.ndarray:
+    """
+    Map positions among the scored `rows` (a slice, an array of row numbers or all rows if None) back to row numbers.
+    """
+    if isinstance(rows, slice):
+        return positions + rows.indices(num_rows)[0]
+    if rows is not None:
+        return np.asarray(rows)[positions]
+    return positions
+
+
+class FlatIndex:
+    """
+    Exact search, scoring the queries against every row of the embedding store.
+
+    It holds no data of its own, the rows are read from the store, so there is nothing to add, build or persist.
+    """
+
+    # Upper bound of the scores matrix computed at once, in number of floats
+    _MAX_BLOCK_SCORES = 1 << 26
+
+    def __init__(self, store: Union[EmbeddingStore, MmapEmbeddingStore]) -> None:
+        self.store = store
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    @property
+    def min_train_size(self) -> int:
+        return 0
+
+    @property
+    def is_ready(self) -> bool:
+        return True
+
+    def build(self, vectors: np.ndarray) -> None:
+        pass
+
+    def add(self, vectors: np.ndarray) -> None:
+        pass
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int,
+        rows: Optional[Union[slice, np.ndarray]] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The `k` best rows for each query, only among `rows` if given (a slice of contiguous rows or an array of row numbers).
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.store.dim)
+        if isinstance(rows, slice):
+            num_rows = len(range(*rows.indices(len(self.store))))
+        else:
+            num_rows = len(self.store) if rows is None else len(rows)
+        k = min(k, num_rows)
+        all_scores = np.empty((len(queries), k), dtype=np.float32)
+        all_rows = np.empty((len(queries), k), dtype=np.int64)
+        block = max(1, self._MAX_BLOCK_SCORES // max(num_rows, 1))
+        for start in range(0, len(queries), block):
+            scores = self.store.scores_batch(queries[start : start + block], rows)
+            (
+                all_scores[start : start + block],
+                all_rows[start : start + block],
+            ) = topk_rows(scores, k)
+        return all_scores, positions_to_rows(all_rows, rows, len(self.store))
+
+    def save(self, path: Union[str, Path]) -> None:
+        pass
+
+
+def _write_faiss_index(index: "faiss.Index", path: Union[str, Path]) -> None:
+    """
+    Write `index` to a temporary file swapped in with `os.replace`, a crash never leaves a partial index at `path`.
+    """
+    import faiss
+
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    faiss.write_index(index, str(tmp_path))
+    os.replace(tmp_path, path)
+
+
+class FaissIndex:
+    """
+    Approximate search with a faiss `ivf` (inverted lists) or `hnsw` (graph) index over inner products.
+
+    The faiss ids are the row numbers of the embedding store. An `ivf` index has to be trained before rows can be added, it is not ready until `build` is called with at least `min_train_size` rows.
+
+    - `ivf`: `nlist` lists, `nprobe` of them are scanned per query (higher is slower and more accurate).
+    - `hnsw`: `hnsw_m` neighbours per node, `ef_construction` and `ef_search` candidate list sizes (higher is slower and more accurate).
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        backend: str,
+        nlist: int = 1024,
+        nprobe: int = 16,
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+    ) -> None:
+        if backend not in ("ivf", "hnsw"):
+            raise ValueError(f"Unknown faiss index backend: {backend}")
+        self.dim = dim
+        self.backend = backend
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._index = self._create()
+
+    def __len__(self) -> int:
+        return self._index.ntotal
+
+    @property
+    def min_train_size(self) -> int:
+        # faiss warns below 39 training points per list
+        return self.nlist * 39 if self.backend == "ivf" else 0
+
+    @property
+    def is_ready(self) -> bool:
+        return self._index.is_trained
+
+    def _create(self) -> "faiss.Index":
+        import faiss
+
+        if self.backend == "ivf":
+            quantizer = faiss.IndexFlatIP(self.dim)
+            index = faiss.IndexIVFFlat(
+                quantizer, self.dim, self.nlist, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexHNSWFlat(
+                self.dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT
+            )
+            index.hnsw.efConstruction = self.ef_construction
+        self._configure(index)
+        return index
+
+    def _configure(self, index: "faiss.Index") -> None:
+        if self.backend == "ivf":
+            index.nprobe = self.nprobe
+        else:
+            index.hnsw.efSearch = self.ef_search
+
+    def build(self, vectors: np.ndarray) -> None:
+        """
+        (Re)build the index from all the rows of the store.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) < self.min_train_size:
+            return
+        self._index = self._create()
+        if not self._index.is_trained:
+            self._index.train(vectors)
+        self._index.add(vectors)
+
+    def add(self, vectors: np.ndarray) -> None:
+        self._index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        return self._index.search(queries, k)
+
+    def save(self, path: Union[str, Path]) -> None:
+        _write_faiss_index(self._index, path)
+
+    def load(self, path: Union[str, Path]) -> None:
+        import faiss
+
+        self._index = faiss.read_index(str(path))
+        self._configure(self._index)
+
+
+class QuantizedIndex(ABC):
+    """
+    Compressed codes of the embeddings kept in memory and searched approximately, the best `k * rescore_factor` candidates of each query are then re-scored exactly against the float32 rows of the store.
+
+    Paired with an `mmap` store, the float32 rows stay on disk and only the candidates are read. Subclasses define the codes.
+    """
+
+    def __init__(
+        self,
+        store: Union[EmbeddingStore, MmapEmbeddingStore],
+        rescore_factor: int = 4,
+    ) -> None:
+        self.store = store
+        self.dim = store.dim
+        self.rescore_factor = max(rescore_factor, 1)
+
+    @abstractmethod
+    def _candidates(self, queries: np.ndarray, n: int) -> np.ndarray:
+        """
+        The rows of the best candidates of each query scored on the codes, at most `n` per query, -1 where there are fewer.
+        """
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        candidates = self._candidates(queries, k * self.rescore_factor)
+        if candidates.shape[1] == 0:
+            return candidates.astype(np.float32), candidates
+
+        # Score the union of the candidates once, then pick each query's own
+        rows = np.unique(candidates[candidates >= 0])
+        exact = self.store.scores_batch(queries, rows)
+        positions = np.searchsorted(rows, np.maximum(candidates, 0))
+        scores = (
+            np.take_along_axis(exact, positions, axis=1)
+            if len(rows)
+            else np.zeros(candidates.shape, dtype=np.float32)
+        )
+        scores[candidates < 0] = -np.inf
+        top, order = topk_rows(scores, k)
+        return top, np.take_along_axis(candidates, order, axis=1)
+
+
+class ScalarQuantizedIndex(QuantizedIndex):
+    """
+    int8 scalar quantization: a row is stored as int8 codes and a float32 scale, `dim + 4` bytes instead of `4 * dim`. The codes need no training, the index is always ready.
+
+    The file is a header followed by one `(scale, codes)` record per row. `save` appends the rows added since the last `save` or `load`, the whole file is only written again (into a temporary file swapped in with `os.replace`) after a `build` or when it does not hold the expected rows.
+    """
+
+    # Upper bound of the block of codes decoded at once, in number of floats
+    _MAX_BLOCK_SCORES = 1 << 24
+    _MAGIC = b"PAINT8CD"
+    _HEADER = struct.Struct("<8sI")
+
+    def __init__(
+        self,
+        store: Union[EmbeddingStore, MmapEmbeddingStore],
+        rescore_factor: int = 4,
+    ) -> None:
+        super().__init__(store, rescore_factor)
+        self._size = 0
+        self._codes = np.empty((1024, self.dim), dtype=np.int8)
+        self._scales = np.empty((1024,), dtype=np.float32)
+        self._record = np.dtype([("scale", "<f4"), ("codes", "i1", (self.dim,))])
+        # Rows in the file written or read last, None when it has to be written again
+        self._saved: Optional[int] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes[: self._size].nbytes + self._scales[: self._size].nbytes
+
+    @property
+    def min_train_size(self) -> int:
+        return 0
+
+    @property
+    def is_ready(self) -> bool:
+        return True
+
+    def build(self, vectors: np.ndarray) -> None:
+        self._size = 0
+        self._saved = None
+        self.add(vectors)
+
+    def add(self, vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        n = len(vectors)
+        if self._size + n > len(self._codes):
+            capacity = len(self._codes)
+            while capacity < self._size + n:
+                capacity *= 2
+            codes = np.empty((capacity, self.dim), dtype=np.int8)
+            scales = np.empty((capacity,), dtype=np.float32)
+            codes[: self._size] = self._codes[: self._size]
+            scales[: self._size] = self._scales[: self._size]
+            self._codes, self._scales = codes, scales
+
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        self._codes[self._size : self._size + n] = np.rint(vectors / scales[:, None])
+        self._scales[self._size : self._size + n] = scales
+        self._size += n
+
+    def _candidates(self, queries: np.ndarray, n: int) -> np.ndarray:
+        # The best `n` rows of each block of codes, then the best among those
+        block = max(1, self._MAX_BLOCK_SCORES // max(len(queries), self.dim))
+        all_scores, all_rows = [], []
+        for start in range(0, self._size, block):
+            end = min(start + block, self._size)
+            scores = queries @ self._codes[start:end].T.astype(np.float32)
+            scores *= self._scales[start:end]
+            top, rows = topk_rows(scores, n)
+            all_scores.append(top)
+            all_rows.append(rows + start)
+        if not all_rows:
+            return np.empty((len(queries), 0), dtype=np.int64)
+        _, positions = topk_rows(np.concatenate(all_scores, axis=1), n)
+        return np.take_along_axis(np.concatenate(all_rows, axis=1), positions, axis=1)
+
+    def _records(self, start: int, end: int) -> np.ndarray:
+        records = np.empty((end - start,), dtype=self._record)
+        records["scale"] = self._scales[start:end]
+        records["codes"] = self._codes[start:end]
+        return records
+
+    def save(self, path: Union[str, Path]) -> None:
+        path = Path(path)
+        expected = (
+            None
+            if self._saved is None
+            else self._HEADER.size + self._saved * self._record.itemsize
+        )
+        if expected is not None and path.exists() and path.stat().st_size == expected:
+            if self._saved < self._size:
+                with open(path, "ab") as f:
+                    self._records(self._saved, self._size).tofile(f)
+        else:
+            tmp_path = path.with_name(f"{path.name}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(self._HEADER.pack(self._MAGIC, self.dim))
+                self._records(0, self._size).tofile(f)
+            os.replace(tmp_path, path)
+        self._saved = self._size
+
+    def load(self, path: Union[str, Path]) -> None:
+        with open(path, "rb") as f:
+            header = f.read(self._HEADER.size)
+            data = f.read()
+        self._size, self._saved = 0, None
+        if len(header) < self._HEADER.size or self._HEADER.unpack(header) != (
+            self._MAGIC,
+            self.dim,
+        ):
+            # Another format or dimension, rebuilt from the store
+            return
+        num_rows = len(data) // self._record.itemsize
+        records = np.frombuffer(data, dtype=self._record, count=num_rows)
+        capacity = max(num_rows, 1024)
+        self._codes = np.empty((capacity, self.dim), dtype=np.int8)
+        self._scales = np.empty((capacity,), dtype=np.float32)
+        self._codes[:num_rows] = records["codes"]
+        self._scales[:num_rows] = records["scale"]
+        self._size = num_rows
+        # A record cut by a crash is dropped, the file is then written again by `save`
+        if len(data) == num_rows * self._record.itemsize:
+            self._saved = num_rows
+
+
+class ProductQuantizedIndex(QuantizedIndex):
+    """
+    faiss product quantization: a row is stored as `pq_m` bytes, one 8 bits centroid per sub-vector (`pq_m` must divide the dimension). Like `ivf`, the index is not ready until `build` is called with at least `min_train_size` rows.
+    """
+
+    _PQ_BITS = 8
+
+    def __init__(
+        self,
+        store: Union[EmbeddingStore, MmapEmbeddingStore],
+        pq_m: int = 16,
+        rescore_factor: int = 4,
+    ) -> None:
+        super().__init__(store, rescore_factor)
+        self.pq_m = pq_m
+        self._index = self._create()
+
+    def __len__(self) -> int:
+        return self._index.ntotal
+
+    @property
+    def nbytes(self) -> int:
+        return self._index.ntotal * self._index.code_size
+
+    @property
+    def min_train_size(self) -> int:
+        # faiss warns below 39 training points per centroid
+        return (1 << self._PQ_BITS) * 39
+
+    @property
+    def is_ready(self) -> bool:
+        return self._index.is_trained
+
+    def _create(self) -> "faiss.Index":
+        import faiss
+
+        return faiss.IndexPQ(
+            self.dim, self.pq_m, self._PQ_BITS, faiss.METRIC_INNER_PRODUCT
+        )
+
+    def build(self, vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) < self.min_train_size:
+            return
+        self._index = self._create()
+        self._index.train(vectors)
+        self._index.add(vectors)
+
+    def add(self, vectors: np.ndarray) -> None:
+        self._index.add(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    def _candidates(self, queries: np.ndarray, n: int) -> np.ndarray:
+        if self._index.ntotal == 0:
+            return np.empty((len(queries), 0), dtype=np.int64)
+        _, rows = self._index.search(
+            np.ascontiguousarray(queries), min(n, self._index.ntotal)
+        )
+        return rows
+
+    def save(self, path: Union[str, Path]) -> None:
+        _write_faiss_index(self._index, path)
+
+    def load(self, path: Union[str, Path]) -> None:
+        import faiss
+
+        self._index = faiss.read_index(str(path))
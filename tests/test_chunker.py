@@ -0,0 +1,96 @@
+import random
+import unittest
+
+from src.chunker import MarkdownChunker, estimate_tokens
+
+
+def markdown_blocks(rng: random.Random, num_blocks: int) -> list[str]:
+    """
+    Blocks of a markdown document as rendered by marker: headings, paragraphs, tables, lists, code and some paragraphs longer than a chunk.
+    """
+
+    def words(n: int) -> str:
+        return " ".join(f"w{rng.randrange(1000)}" for _ in range(n))
+
+    blocks = []
+    for i in range(num_blocks):
+        kind = rng.choice(["heading", "paragraph", "table", "list", "code", "long"])
+        if kind == "heading":
+            blocks.append(f"{'#' * rng.randint(1, 3)} Section {i}")
+        elif kind == "paragraph":
+            blocks.append(words(rng.randint(5, 60)))
+        elif kind == "table":
+            rows = [f"| {words(2)} | {words(3)} |" for _ in range(rng.randint(2, 6))]
+            blocks.append("\n".join(["| a | b |", "|---|---|", *rows]))
+        elif kind == "list":
+            blocks.append("\n".join(f"- {words(8)}" for _ in range(rng.randint(2, 5))))
+        elif kind == "code":
+            # A blank line inside a fence does not end the block
+            blocks.append(f"```python\nx = {i}\n\ny = '{words(3)}'\n```")
+        else:
+            blocks.append(words(rng.randint(200, 400)))
+    return blocks
+
+
+class MarkdownChunkerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.chunker = MarkdownChunker(max_tokens=64, overlap_tokens=8)
+        self.documents = [markdown_blocks(random.Random(seed), 60) for seed in range(5)]
+
+    def test_chunks_are_slices_of_the_source(self) -> None:
+        for blocks in self.documents:
+            source = "\n\n".join(blocks)
+            chunks = self.chunker.chunk(source)
+            self.assertTrue(chunks)
+            for chunk in chunks:
+                self.assertEqual(chunk.text, source[chunk.start : chunk.end])
+            starts = [chunk.start for chunk in chunks]
+            self.assertEqual(starts, sorted(starts))
+
+    def test_pieces_chunk_like_the_whole_document(self) -> None:
+        rng = random.Random(0)
+        for blocks in self.documents:
+            source = "\n\n".join(blocks)
+            # Pieces of a few blocks each, like the page ranges of a PDF
+            cuts = sorted(rng.sample(range(1, len(blocks)), 8))
+            pieces = [
+                "\n\n".join(blocks[i:j])
+                for i, j in zip([0, *cuts], [*cuts, len(blocks)])
+            ]
+            self.assertEqual(
+                list(self.chunker.iter_chunks(pieces)), self.chunker.chunk(source)
+            )
+            self.assertEqual(
+                list(self.chunker.iter_chunks([source])), self.chunker.chunk(source)
+            )
+
+    def test_token_budget(self) -> None:
+        for blocks in self.documents:
+            for chunk in self.chunker.chunk("\n\n".join(blocks)):
+                # Windows of a long block are cut by characters, one token of rounding
+                self.assertLessEqual(estimate_tokens(chunk.text), 64 + 1)
+
+    def test_headings_start_chunks(self) -> None:
+        for blocks in self.documents:
+            chunks = self.chunker.chunk("\n\n".join(blocks))
+            headings = [block for block in blocks if block.startswith("#")]
+            self.assertTrue(headings)
+            starting = [chunk.text for chunk in chunks if chunk.text.startswith("#")]
+            self.assertEqual([text.split("\n")[0] for text in starting], headings)
+            for chunk in chunks:
+                self.assertNotIn("\n#", chunk.text)
+
+    def test_long_block_windows_overlap(self) -> None:
+        text = " ".join(f"w{i}" for i in range(2000))
+        chunks = self.chunker.chunk(text)
+        self.assertGreater(len(chunks), 1)
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertLess(chunk.start, previous.end)
+            self.assertGreater(chunk.start, previous.start)
+        self.assertEqual(chunks[0].start, 0)
+        self.assertEqual(chunks[-1].end, len(text))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import tempfile
+import unittest
+
+from pathlib import Path
+from dataclasses import asdict
+
+from src.history_store import HistoryStore
+from src.types.agent_info import Conversation
+
+
+def conversation(round_id: int, role: str) -> Conversation:
+    return Conversation(
+        conversation_id=f"{round_id}-{role}",
+        round_id=round_id,
+        timestamp="2024-01-01 00:00:00",
+        role=role,
+        content=f"{role} message of round {round_id}\nover two lines",
+        file_refs=[],
+    )
+
+
+def rounds(first: int, last: int) -> list[Conversation]:
+    return [
+        conversation(round_id, role)
+        for round_id in range(first, last)
+        for role in ["user", "assistant"]
+    ]
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = Path(tmp_dir.name) / "chat.json"
+
+    def open(self) -> HistoryStore:
+        return HistoryStore(self.path)
+
+    def append(self, history: HistoryStore, conversations: list[Conversation]) -> None:
+        for conv in conversations:
+            history.append(conv)
+
+    def test_tail_and_rounds(self) -> None:
+        history = self.open()
+        self.assertEqual(history.tail(4), [])
+        self.append(history, rounds(0, 10))
+
+        self.assertEqual(len(history), 20)
+        self.assertEqual(history.tail(4), rounds(8, 10))
+        self.assertEqual(history.tail(100), rounds(0, 10))
+        self.assertEqual(history.read(2, 6), rounds(1, 3))
+        self.assertEqual(history.read_rounds(7), rounds(7, 10))
+        self.assertEqual(history.read_rounds(0), rounds(0, 10))
+        self.assertEqual(history.read_rounds(10), [])
+        self.assertEqual(self.open().tail(4), rounds(8, 10))
+
+    def test_records_without_index_entries(self) -> None:
+        history = self.open()
+        self.append(history, rounds(0, 5))
+        # A crash between appending records and their index entries
+        with open(self.path, "a") as f:
+            for conv in rounds(5, 7):
+                f.write(json.dumps(asdict(conv)) + "\n")
+
+        reopened = self.open()
+        self.assertEqual(len(reopened), 14)
+        self.assertEqual(reopened.tail(4), rounds(5, 7))
+        self.assertEqual(reopened.read_rounds(4), rounds(4, 7))
+
+        self.append(reopened, rounds(7, 8))
+        self.assertEqual(reopened.tail(6), rounds(5, 8))
+        self.assertEqual(self.open().read(0, 100), rounds(0, 8))
+
+    def test_torn_record(self) -> None:
+        history = self.open()
+        self.append(history, rounds(0, 3))
+        with open(self.path, "a") as f:
+            f.write(json.dumps(asdict(conversation(3, "user")))[:20])
+
+        reopened = self.open()
+        self.assertEqual(reopened.tail(2), rounds(2, 3))
+        self.append(reopened, rounds(3, 4))
+        self.assertEqual(self.open().read(0, 100), rounds(0, 4))
+
+    def test_missing_or_stale_index(self) -> None:
+        history = self.open()
+        self.append(history, rounds(0, 6))
+        history.index_path.unlink()
+        self.assertEqual(self.open().read_rounds(3), rounds(3, 6))
+
+        # The history replaced by a shorter one, the index points past it
+        with open(self.path, "w") as f:
+            for conv in rounds(0, 2):
+                f.write(json.dumps(asdict(conv)) + "\n")
+        reopened = self.open()
+        self.assertEqual(len(reopened), 4)
+        self.assertEqual(reopened.tail(10), rounds(0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import sys
+import unittest
+import subprocess
+
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Only loaded when a PDF is converted or an approximate index is used
+HEAVY_MODULES = {"marker", "torch", "faiss", "sentence_transformers"}
+# Cumulative import time of `main`, in microseconds (about 1s when measured)
+BUDGET_US = 3_000_000
+
+
+def import_times(module: str) -> dict[str, int]:
+    """
+    The cumulative import time in microseconds of every module loaded by `import <module>` in a fresh interpreter, see `python -X importtime`.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+class ImportTimeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.times = import_times("main")
+
+    def test_heavy_modules_not_imported(self) -> None:
+        loaded = {name.split(".")[0] for name in self.times}
+        self.assertFalse(loaded & HEAVY_MODULES, sorted(loaded & HEAVY_MODULES))
+
+    def test_within_budget(self) -> None:
+        self.assertLess(self.times["main"], BUDGET_US)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+import json
+import zlib
+import tempfile
+import unittest
+import numpy as np
+
+from types import SimpleNamespace
+
+from src.cfg_mappings import RAGConfigs
+from src.paper_rag import PaperRAG
+
+DIM = 16
+
+
+def embed(chunks) -> np.ndarray:
+    """
+    Deterministic embeddings seeded by the text, no embedding requests.
+    """
+    chunks = [chunks] if isinstance(chunks, str) else chunks
+    vectors = np.array(
+        [
+            np.random.default_rng(zlib.crc32(chunk.encode("utf-8"))).standard_normal(
+                DIM
+            )
+            for chunk in chunks
+        ],
+        dtype=np.float32,
+    ).reshape(-1, DIM)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def document(name: str, version: int = 0, paragraphs: int = 4) -> list[str]:
+    return [
+        f"{name} version {version} paragraph {i} "
+        + " ".join(f"w{i}{j}" for j in range(20))
+        for i in range(paragraphs)
+    ]
+
+
+class PaperRAGStoreTest(unittest.TestCase):
+    """
+    The store on disk (append-only metadata and embedding rows, see `PaperRAG._persist`) as seen by new or concurrent instances of `PaperRAG` on the same directory.
+    """
+
+    def new_store(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.store_dir = tmp_dir.name
+
+    def open(self, **kwargs) -> PaperRAG:
+        cfgs = RAGConfigs(
+            num_chunks=32,
+            overlap=4,
+            store_dir=self.store_dir,
+            embedding_model="test",
+            meta_file=".meta",
+            embed_file="embeddings.npy",
+            embed_dim=DIM,
+            topk=3,
+            embed_cache_file="",
+            query_cache_file=None,
+            **kwargs,
+        )
+        # A new instance, not the process-wide singleton
+        rag = PaperRAG.__wrapped__(
+            cfgs, SimpleNamespace(api_key="test", base_url="http://localhost")
+        )
+        rag.embed = embed
+        return rag
+
+    def add(self, rag: PaperRAG, name: str, version: int = 0) -> list[str]:
+        pieces = document(name, version)
+        rag.vectorize_stream(pieces, name)
+        return rag.split_document("\n\n".join(pieces))
+
+    def assertFinds(self, rag: PaperRAG, chunks: list[str]) -> None:
+        """
+        Each chunk is its own best match: its row holds its embedding.
+        """
+        results = rag.search_batch(chunks, topk=1, query_embeds=embed(chunks))
+        self.assertEqual([r[0][1]["chunk"] for r in results], chunks)
+
+    def assertMissing(self, rag: PaperRAG, chunks: list[str]) -> None:
+        results = rag.search_batch(chunks, topk=3, query_embeds=embed(chunks))
+        found = {info["chunk"] for result in results for _, info in result}
+        self.assertFalse(found & set(chunks))
+
+    def test_reopen(self) -> None:
+        for storage in ["memory", "mmap"]:
+            with self.subTest(storage=storage):
+                self.new_store()
+                rag = self.open(storage=storage)
+                chunks = self.add(rag, "a.pdf") + self.add(rag, "b.pdf")
+                self.assertFinds(self.open(storage=storage), chunks)
+
+    def test_reopen_after_torn_metadata_line(self) -> None:
+        for storage in ["memory", "mmap"]:
+            with self.subTest(storage=storage):
+                self.new_store()
+                rag = self.open(storage=storage)
+                a_chunks = self.add(rag, "a.pdf")
+                # A crash in the middle of appending a row
+                with open(rag.meta_file, "ab") as f:
+                    f.write(b'{"chunk_id": 1, "ch')
+
+                reopened = self.open(storage=storage)
+                self.assertFinds(reopened, a_chunks)
+                c_chunks = self.add(reopened, "c.pdf")
+
+                self.assertFinds(self.open(storage=storage), a_chunks + c_chunks)
+                with open(rag.meta_file) as f:
+                    for line in f:
+                        json.loads(line)
+
+    def test_reopen_with_extra_segment_rows(self) -> None:
+        for storage in ["memory", "mmap"]:
+            with self.subTest(storage=storage):
+                self.new_store()
+                rag = self.open(storage=storage)
+                a_chunks = self.add(rag, "a.pdf")
+                # Rows appended before a crash, their metadata was never written
+                with open(rag.embed_file.with_suffix(".seg"), "ab") as f:
+                    f.write(embed(["lost 0", "lost 1", "lost 2"]).tobytes())
+
+                reopened = self.open(storage=storage)
+                self.assertFinds(reopened, a_chunks)
+                self.assertMissing(reopened, ["lost 0", "lost 1", "lost 2"])
+                c_chunks = self.add(reopened, "c.pdf")
+
+                final = self.open(storage=storage)
+                self.assertFinds(final, a_chunks + c_chunks)
+                self.assertMissing(final, ["lost 0", "lost 1", "lost 2"])
+
+    def test_replaced_document_is_compacted(self) -> None:
+        for kwargs in [
+            {"storage": "memory"},
+            {"storage": "mmap", "retrieval": "hybrid"},
+            {"quantization": "int8"},
+        ]:
+            with self.subTest(**kwargs):
+                self.new_store()
+                rag = self.open(compact_ratio=0.2, **kwargs)
+                b_chunks = self.add(rag, "b.pdf")
+                for version in range(3):
+                    a_chunks = self.add(rag, "a.pdf", version)
+
+                # The replaced versions of a.pdf were dropped from the files
+                with open(rag.meta_file) as f:
+                    records = [json.loads(line) for line in f]
+                texts = {r["chunk"]["chunk"] for r in records if "chunk" in r}
+                self.assertEqual(texts, set(a_chunks + b_chunks))
+                self.assertFalse(any("deleted" in r for r in records))
+                self.assertFalse(rag.embed_file.exists())
+
+                reopened = self.open(compact_ratio=0.2, **kwargs)
+                self.assertFinds(reopened, a_chunks + b_chunks)
+
+    def test_refresh_sees_other_instance(self) -> None:
+        for storage in ["memory", "mmap"]:
+            with self.subTest(storage=storage):
+                self.new_store()
+                reader, writer = self.open(storage=storage), self.open(storage=storage)
+                self.assertFalse(reader.refresh())
+
+                chunks = self.add(writer, "a.pdf")
+                self.assertTrue(reader.refresh())
+                self.assertFinds(reader, chunks)
+                self.assertFalse(reader.refresh())
+
+                # A replaced document is replaced for the reader too
+                new_chunks = self.add(writer, "a.pdf", version=1)
+                self.assertTrue(reader.refresh())
+                self.assertFinds(reader, new_chunks)
+                self.assertMissing(reader, chunks)
+
+    def test_persist_after_other_instance(self) -> None:
+        for storage in ["memory", "mmap"]:
+            with self.subTest(storage=storage):
+                self.new_store()
+                first, second = self.open(storage=storage), self.open(storage=storage)
+                a_chunks = self.add(first, "a.pdf")
+                # `second` did not see a.pdf, it is reloaded before writing after it
+                b_chunks = self.add(second, "b.pdf")
+                self.assertFinds(second, a_chunks + b_chunks)
+
+                c_chunks = self.add(first, "c.pdf")
+                self.assertFinds(
+                    self.open(storage=storage), a_chunks + b_chunks + c_chunks
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()